@@ -0,0 +1,319 @@
+"""
+Benchmarks for the hot paths of pytarallo.
+
+Everything runs locally: network benchmarks use a FakeServer. Results are printed as JSON, and can be
+compared with the ones from a previous run to catch regressions:
+
+    python bench.py --output new.json
+    python bench.py --compare old.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Optional, List, Dict, Any
+
+from pytarallo.AuditEntry import AuditEntry, AuditChanges
+from pytarallo.Codec import JsonCodec, get_codec
+from pytarallo.FakeServer import FakeServer
+from pytarallo.Item import Item
+from pytarallo.ItemIndex import ItemIndex
+from pytarallo.ItemToUpload import ItemToUpload
+from pytarallo.Product import Product
+from pytarallo.Replica import Replica
+from pytarallo.Tarallo import Tarallo
+from pytarallo.ValidationCache import ValidationCache
+
+try:
+    from pytarallo.AsyncTarallo import AsyncTarallo
+except ImportError:
+    AsyncTarallo = None
+
+
+def wide_tree(width: int) -> dict:
+    """
+    A location containing width items, each one with a product
+    """
+    contents = []
+    for n in range(width):
+        contents.append({
+            'code': f'R{n}',
+            'features': {'type': 'ram', 'working': 'yes', 'sn': f'SN{n:08}', 'color': 'green'},
+            'product': {'brand': 'Samsung', 'model': f'M3 78T{n % 16}', 'variant': 'default',
+                        'features': {'type': 'ram', 'capacity-byte': 1073741824, 'ram-type': 'ddr2'}},
+        })
+    return {'code': 'Wide', 'features': {'type': 'location'}, 'location': ['Polito'], 'contents': contents}
+
+
+def deep_tree(depth: int) -> dict:
+    """
+    A chain of depth items, each one inside the previous one
+    """
+    leaf = {'code': f'D{depth}', 'features': {'type': 'location'}}
+    for n in range(depth - 1, 0, -1):
+        leaf = {'code': f'D{n}', 'features': {'type': 'location'}, 'contents': [leaf]}
+    leaf['location'] = ['Polito']
+    return leaf
+
+
+class Runner(object):
+    def __init__(self, repeat: int, only: Optional[str] = None):
+        self.repeat = repeat
+        self.only = only
+        self.results: List[Dict[str, Any]] = []
+        self.memory: List[Dict[str, Any]] = []
+
+    def run(self, name: str, func: Callable[[], Any], operations: int = 1, setup: Optional[Callable] = None):
+        """
+        Run func self.repeat times, and record the best and mean time per operation
+        """
+        if self.only is not None and self.only not in name:
+            return
+        times = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            times.append((time.perf_counter() - start) / operations)
+        result = {
+            'name': name,
+            'operations': operations,
+            'repeat': self.repeat,
+            'best': min(times),
+            'mean': statistics.mean(times),
+            'ops_per_second': 1 / min(times),
+        }
+        self.results.append(result)
+        print(f"{name}: {result['best'] * 1e6:.1f} µs/op", file=sys.stderr)
+
+    def measure(self, name: str, bytes_per_object: float):
+        if self.only is not None and self.only not in name:
+            return
+        self.memory.append({'name': name, 'bytes_per_object': bytes_per_object})
+        print(f"{name}: {bytes_per_object:.0f} bytes/object", file=sys.stderr)
+
+
+def bench_items(runner: Runner, size: int, depth: int):
+    wide = wide_tree(size)
+    deep = deep_tree(depth)
+    wide_item = Item(wide)
+    deep_item = Item(deep)
+    wide_upload = ItemToUpload(wide_item)
+    deep_upload = ItemToUpload(deep_item)
+
+    runner.run(f'item_from_json_wide_{size}', lambda: Item(wide))
+    runner.run(f'item_from_json_deep_{depth}', lambda: Item(deep))
+    runner.run(f'serializable_wide_{size}', wide_upload.serializable)
+    runner.run(f'serializable_deep_{depth}', deep_upload.serializable)
+    runner.run(f'item_to_upload_clone_wide_{size}', lambda: ItemToUpload(wide_item))
+    runner.run(f'item_to_upload_clone_deep_{depth}', lambda: ItemToUpload(deep_item))
+
+
+def bench_index(runner: Runner, size: int):
+    item = Item(wide_tree(size))
+    index = ItemIndex(item)
+
+    def walk():
+        stack = [item]
+        found = []
+        while len(stack) > 0:
+            current = stack.pop()
+            if current.features.get('sn') == 'SN00000042':
+                found.append(current)
+            stack.extend(current.contents)
+        return found
+
+    runner.run(f'item_index_build_{size}', lambda: ItemIndex(item))
+    runner.run(f'item_index_find_{size}', lambda: index.find('sn', 'SN00000042'))
+    runner.run(f'item_walk_find_{size}', walk)
+
+
+def bench_codecs(runner: Runner, size: int):
+    data = wide_tree(size)
+    # get_codec() is the fastest one installed, possibly json itself
+    for codec in {codec.name: codec for codec in (JsonCodec(), get_codec())}.values():
+        encoded = codec.dumps(data)
+        runner.run(f'codec_{codec.name}_loads_{size}', lambda: codec.loads(encoded))
+        runner.run(f'codec_{codec.name}_dumps_{size}', lambda: codec.dumps(data))
+
+
+def bench_history(runner: Runner, entries: int):
+    with FakeServer(computers=1) as server:
+        tarallo = Tarallo(server.url, server.token)
+        # Build a long history by moving a RAM back and forth
+        for n in range(entries):
+            tarallo.move('R1', 'Shelf1' if n % 2 == 0 else 'PC1')
+        runner.run(f'get_history_{entries}', lambda: tarallo.get_history('R1', entries))
+        runner.run(f'iter_history_{entries}', lambda: list(tarallo.iter_history('R1', entries)))
+        runner.run(f'iter_history_{entries}_first', lambda: next(tarallo.iter_history('R1', entries)))
+
+
+def bench_requests(runner: Runner, requests: int, latency: float, workers: int):
+    with FakeServer(computers=max(requests // 6, 1), latency=latency) as server:
+        codes = [f'R{n % (max(requests // 6, 1) * 2) + 1}' for n in range(requests)]
+        tarallo = Tarallo(server.url, server.token)
+
+        def sequential():
+            for code in codes:
+                tarallo.get_item(code)
+
+        def threaded():
+            for _ in tarallo.get_items(codes, max_workers=workers):
+                pass
+
+        runner.run(f'get_item_sequential_{requests}', sequential, requests)
+        runner.run(f'get_item_threaded_{workers}_{requests}', threaded, requests)
+
+        if AsyncTarallo is not None:
+            # Same client for every repetition, like the Tarallo session above: only the requests are timed
+            loop = asyncio.new_event_loop()
+            async_tarallo = AsyncTarallo(server.url, server.token)
+
+            async def gather():
+                semaphore = asyncio.Semaphore(workers)
+
+                async def get(code):
+                    async with semaphore:
+                        return await async_tarallo.get_item(code)
+                await asyncio.gather(*(get(code) for code in codes))
+
+            try:
+                runner.run(f'get_item_async_{workers}_{requests}', lambda: loop.run_until_complete(gather()), requests)
+            finally:
+                loop.run_until_complete(async_tarallo.close())
+                loop.close()
+
+
+def bench_revalidation(runner: Runner, computers: int, latency: float):
+    with FakeServer(computers=computers, computers_per_shelf=computers, latency=latency) as server:
+        tarallo = Tarallo(server.url, server.token)
+        cached = Tarallo(server.url, server.token, validation_cache=ValidationCache())
+        runner.run(f'get_item_{computers * 6}_items', lambda: tarallo.get_item('Shelf1'))
+        runner.run(f'get_item_{computers * 6}_items_not_modified', lambda: cached.get_item('Shelf1'))
+
+
+def bench_replica(runner: Runner, computers: int):
+    with FakeServer(computers=computers, computers_per_shelf=computers) as server:
+        with Replica(Tarallo(server.url, server.token)) as replica:
+            runner.run(f'replica_snapshot_{computers * 6}_items', lambda: replica.snapshot('Shelf1'))
+            runner.run(f'replica_codes_by_feature_{computers * 6}_items',
+                       lambda: replica.codes_by_feature('type', 'ram'))
+            runner.run(f'replica_get_item_{computers * 6}_items', lambda: replica.get_item('Shelf1'))
+            runner.run(f'replica_sync_{computers * 6}_items', replica.sync)
+
+
+def instance_size(obj) -> int:
+    """
+    Size of the object itself, and its __dict__ if it has one (not what it references)
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def with_dict(obj):
+    """
+    Copy of obj into an instance of an equivalent class with a __dict__ instead of __slots__
+    """
+    attributes = [name for cls in type(obj).__mro__ for name in getattr(cls, '__slots__', ()) if name != '__weakref__']
+    copy = type('Dict' + type(obj).__name__, (object,), {})()
+    for name in attributes:
+        setattr(copy, name, getattr(obj, name))
+    return copy
+
+
+def bench_memory(runner: Runner, size: int):
+    item = Item(wide_tree(1))
+    product = Product({'brand': 'Samsung', 'model': 'M3 78T1', 'variant': 'default', 'features': {'type': 'ram'}})
+    entry = AuditEntry('fake', AuditChanges.Move, time.time(), 'PC1')
+    for obj in (item, ItemToUpload(item), product, entry):
+        name = type(obj).__name__
+        runner.measure(f'memory_{name}', instance_size(obj))
+        runner.measure(f'memory_{name}_with_dict', instance_size(with_dict(obj)))
+
+    # Everything included: features, products, lists, strings...
+    data = wide_tree(size)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = Item(data)
+    runner.measure(f'memory_tree_{size}', (tracemalloc.get_traced_memory()[0] - before) / (size + 1))
+    before = tracemalloc.get_traced_memory()[0]
+    clone = ItemToUpload(tree)
+    runner.measure(f'memory_clone_{size}', (tracemalloc.get_traced_memory()[0] - before) / (size + 1))
+    tracemalloc.stop()
+    del tree, clone
+
+
+def compare(results: List[Dict[str, Any]], memory: List[Dict[str, Any]], previous_file: str,
+            threshold: float) -> bool:
+    """
+    Print how much each benchmark changed, return False if anything is slower or bigger than threshold
+    """
+    with open(previous_file) as f:
+        previous = json.load(f)
+    previous_results = {result['name']: result for result in previous['results']}
+    ok = True
+    for result in results:
+        if result['name'] not in previous_results:
+            continue
+        ratio = result['best'] / previous_results[result['name']]['best']
+        slower = ratio > threshold
+        ok = ok and not slower
+        print(f"{result['name']}: {ratio:.2f}x{' REGRESSION' if slower else ''}", file=sys.stderr)
+    previous_memory = {result['name']: result for result in previous.get('memory', [])}
+    for result in memory:
+        if result['name'] not in previous_memory:
+            continue
+        ratio = result['bytes_per_object'] / previous_memory[result['name']]['bytes_per_object']
+        bigger = ratio > threshold
+        ok = ok and not bigger
+        print(f"{result['name']}: {ratio:.2f}x{' REGRESSION' if bigger else ''}", file=sys.stderr)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pytarallo')
+    parser.add_argument('--quick', action='store_true', help='Smaller inputs and fewer repetitions')
+    parser.add_argument('--only', help='Only run benchmarks whose name contains this string')
+    parser.add_argument('--output', help='Write results to this file instead of stdout')
+    parser.add_argument('--compare', help='Results of a previous run, to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='With --compare, fail if anything is this many times slower (default 1.2)')
+    parser.add_argument('--depth', type=int, default=200, help='Depth of the deep tree')
+    parser.add_argument('--latency', type=float, default=0.002, help='Latency of the server, in seconds')
+    args = parser.parse_args()
+
+    runner = Runner(3 if args.quick else 10, args.only)
+    bench_items(runner, 500 if args.quick else 5000, args.depth)
+    bench_index(runner, 500 if args.quick else 5000)
+    bench_codecs(runner, 500 if args.quick else 5000)
+    bench_history(runner, 100 if args.quick else 1000)
+    bench_requests(runner, 60 if args.quick else 300, args.latency, 16)
+    bench_revalidation(runner, 100 if args.quick else 1000, args.latency)
+    bench_replica(runner, 20 if args.quick else 100)
+    bench_memory(runner, 10000 if args.quick else 100000)
+
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': runner.results,
+        'memory': runner.memory,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.compare and not compare(runner.results, runner.memory, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+import urllib.parse
+from typing import Optional, Union
+
+import httpx
+
+from .AuditEntry import AuditEntry, AuditChanges
+from .Codec import JsonCodec, get_codec
+from .Errors import *
+from .Item import Item
+from .ItemToUpload import ItemToUpload
+from .ProductRegistry import ProductRegistry
+from .ProductToUpload import ProductToUpload
+
+
+# same as raises_no_internet_connection_error, for coroutines and httpx
+def async_raises_no_internet_connection_error(func):
+    async def inner(*args, **kwargs):
+        try:
+            res = await func(*args, **kwargs)
+            return res
+        except httpx.NetworkError:
+            raise NoInternetConnectionError("Your computer is not connected to the Internet.")
+    return inner
+
+
+class AsyncTarallo(object):
+    """
+    This class handles the Tarallo session with asyncio.
+
+    Every method of Tarallo is available here as a coroutine, returning the same objects and raising
+    the same exceptions. All the requests go through a single connection pool, so many of them can be
+    in flight at the same time:
+
+        async with AsyncTarallo(url, token) as tarallo:
+            items = await asyncio.gather(*(tarallo.get_item(code) for code in codes))
+    """
+
+    def __init__(self, url: str, token: str, max_connections: int = 100, max_keepalive_connections: int = 20,
+                 codec: Union[str, JsonCodec, None] = None):
+        """
+        :param url: Tarallo URL
+        :param token: Token (go to Options > Get token)
+        :param max_connections: Maximum number of concurrent connections to the server
+        :param max_keepalive_connections: Maximum number of idle connections kept open for reuse
+        :param codec: Same as Tarallo
+        """
+        self.url = url.rstrip('/')
+        self.token = token.strip()
+        self.codec = get_codec(codec)
+        self.products = ProductRegistry()
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self.__client = httpx.AsyncClient(limits=limits, timeout=None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """
+        Close all the connections in the pool
+        """
+        await self.__client.aclose()
+
+    def __prepare_url(self, url: str) -> str:
+        return self.url + '/' + url.lstrip('/')
+
+    def __prepare_headers(self, headers: Optional[dict] = None, content_type: bool = False) -> dict:
+        if headers is None:
+            headers = {}
+        if content_type and "Content-Type" not in headers:
+            headers["Content-Type"] = "application/json"
+        headers["Authorization"] = "Token " + self.token
+        return headers
+
+    @staticmethod
+    def __check_response(response: httpx.Response):
+        if response.status_code == 401:
+            raise AuthenticationError
+        if response.status_code >= 500:
+            raise ServerError
+
+    # httpx.AsyncClient() wrapper methods
+    # These guys implement further checks
+    @async_raises_no_internet_connection_error
+    async def get(self, url: str) -> httpx.Response:
+        response = await self.__client.get(self.__prepare_url(url), headers=self.__prepare_headers())
+        self.__check_response(response)
+        return response
+
+    @async_raises_no_internet_connection_error
+    async def delete(self, url: str) -> httpx.Response:
+        response = await self.__client.delete(self.__prepare_url(url), headers=self.__prepare_headers())
+        self.__check_response(response)
+        return response
+
+    @async_raises_no_internet_connection_error
+    async def post(self, url: str, data, headers=None) -> httpx.Response:
+        response = await self.__client.post(self.__prepare_url(url), content=data,
+                                            headers=self.__prepare_headers(headers, True))
+        self.__check_response(response)
+        return response
+
+    @async_raises_no_internet_connection_error
+    async def put(self, url: str, data, headers=None) -> httpx.Response:
+        response = await self.__client.put(self.__prepare_url(url), content=data,
+                                           headers=self.__prepare_headers(headers, True))
+        self.__check_response(response)
+        return response
+
+    @async_raises_no_internet_connection_error
+    async def patch(self, url: str, data, headers=None) -> httpx.Response:
+        response = await self.__client.patch(self.__prepare_url(url), content=data,
+                                             headers=self.__prepare_headers(headers, True))
+        self.__check_response(response)
+        return response
+
+    @staticmethod
+    def urlencode(part: str):
+        return urllib.parse.quote(part, safe='')
+
+    async def status(self):
+        """
+        Returns the status_code of /v2/session, useful for testing purposes.
+        """
+        try:
+            return (await self.get('/v2/session')).status_code
+        except AuthenticationError:
+            return 401
+
+    async def get_item(self, code: str, depth_limit: Optional[int] = None):
+        """
+        Return an Item instance received from the server
+        """
+        url = f'/v2/items/{self.urlencode(code)}?separate'  # try an Item without product
+        if depth_limit is not None:
+            url += '&depth=' + str(int(depth_limit))
+        response = await self.get(url)
+        if response.status_code == 200:
+            return Item(self.codec.loads(response.content), products=self.products)
+        elif response.status_code == 404:
+            raise ItemNotFoundError(f"Item {code} doesn't exist")
+
+    async def get_product_list(self, brand: str, model: str):
+        """
+        Return a list of Product (all the variants) received from the server
+        """
+        url = f'/v2/products/{self.urlencode(brand)}/{self.urlencode(model)}'
+        response = await self.get(url)
+        if response.status_code == 200:
+            return [self.products.resolve(p) for p in self.codec.loads(response.content)]
+        elif response.status_code == 404:
+            raise ProductNotFoundError("Product doesn't exists.")
+
+    async def get_product(self, brand: str, model: str, variant: str = "default"):
+        """
+        Return a Product instance received from the server, the same as before if it hasn't changed
+        """
+        url = f'/v2/products/{self.urlencode(brand)}/{self.urlencode(model)}/{self.urlencode(variant)}'
+        response = await self.get(url)
+        if response.status_code == 200:
+            return self.products.resolve(self.codec.loads(response.content))
+        elif response.status_code == 404:
+            raise ProductNotFoundError("Product doesn't exists.")
+
+    async def add_item(self, item: ItemToUpload):
+        """
+        Add an item to the database and eventually update its code
+        """
+        if item.code is not None:  # check whether an item's code was manually added
+            response = await self.put(f'/v2/items/{self.urlencode(item.code)}',
+                                      data=self.codec.dumps(item.serializable()))
+        else:
+            response = await self.post('/v2/items', data=self.codec.dumps(item.serializable()))
+        if response.status_code == 201:
+            item.code = self.codec.loads(response.content)
+            return True
+        elif response.status_code == 400 or response.status_code == 404:
+            raise ValidationError
+        elif response.status_code == 403:
+            raise NotAuthorizedError
+
+    async def add_product(self, product: ProductToUpload):
+        """
+        Add a product to the database
+
+        :return: True if success, Errors exceptions otherwise
+        """
+        bmv = f"{self.urlencode(product.brand)}/{self.urlencode(product.model)}/{self.urlencode(product.variant)}"
+        response = await self.put(f'/v2/products/{bmv}', data=self.codec.dumps(product.serializable()))
+        self.products.invalidate(product.brand, product.model, product.variant)
+        if response.status_code == 201:
+            return True
+        elif response.status_code == 400 or response.status_code == 404:
+            raise ValidationError
+        elif response.status_code == 403:
+            raise NotAuthorizedError
+
+    async def update_item_features(self, code: str, features: dict):
+        """
+        Send updated features to the database (this is the PATCH endpoint)
+        """
+        response = await self.patch(f'/v2/items/{self.urlencode(code)}/features', self.codec.dumps(features))
+        if response.status_code == 200 or response.status_code == 204:
+            return True
+        elif response.status_code == 400:
+            raise ValidationError("Impossible to update feature/s")
+        elif response.status_code == 404:
+            raise ItemNotFoundError(f"Item {code} doesn't exist")
+
+    async def update_product_features(self, brand: str, model: str, variant: str, features: dict):
+        bmv = f"{self.urlencode(brand)}/{self.urlencode(model)}/{self.urlencode(variant)}"
+        response = await self.patch(f"/v2/products/{bmv}/features", self.codec.dumps(features))
+        self.products.invalidate(brand, model, variant)
+        if response.status_code == 200 or response.status_code == 204:
+            return True
+        elif response.status_code == 400:
+            raise ValidationError("Impossible to update feature/s")
+        elif response.status_code == 404:
+            raise ProductNotFoundError("Product doesn't exist")
+
+    async def move(self, code: str, location: str):
+        """
+        Move an item to another location
+        """
+        response = await self.put(f'v2/items/{self.urlencode(code)}/parent', self.codec.dumps(location))
+        move_status = response.status_code
+        if move_status == 204 or move_status == 201 or move_status == 200:
+            return True
+        elif move_status == 400:
+            raise ValidationError(f"Cannot move {code} into {location}")
+        elif move_status == 404:
+            response_json = self.codec.loads(response.content)
+            if 'item' not in response_json:
+                raise ServerError("Server didn't find an item, but isn't telling us which one")
+            if response_json['item'] == location:
+                raise LocationNotFoundError
+            else:
+                raise ItemNotFoundError(f"Item {response_json['item']} doesn't exist")
+        else:
+            raise RuntimeError(f"Move failed with {move_status}")
+
+    async def lose(self, code: str):
+        """
+        Remove an item from its location, without deleting it
+        """
+        response = await self.delete(f'v2/items/{self.urlencode(code)}/parent')
+        lose_status = response.status_code
+        if lose_status == 204:
+            return True
+        elif lose_status == 400:
+            response_json = self.codec.loads(response.content)
+            if "message" in response_json:
+                raise ValidationError(f"Cannot lose {code}: {response_json['message']}")
+            else:
+                raise ValidationError(f"Cannot lose {code}")
+        elif lose_status == 404:
+            response_json = self.codec.loads(response.content)
+            if 'item' in response_json:
+                raise ItemNotFoundError(f"Item {response_json['item']} doesn't exist")
+            else:
+                raise ServerError("Server didn't find an item, but isn't telling us which one")
+        else:
+            raise RuntimeError(f"Move failed with {lose_status}")
+
+    async def delete_product(self, brand: str, model: str, variant: str):
+        """
+        send a DELETE request to the server to remove a product
+        """
+        bmv = f"{self.urlencode(brand)}/{self.urlencode(model)}/{self.urlencode(variant)}"
+        delete_status = (await self.delete(f"v2/products/{bmv}")).status_code
+        self.products.invalidate(brand, model, variant)
+        if delete_status == 200 or delete_status == 204:
+            # Actually deleted
+            return True
+        if delete_status == 404:
+            return None
+        else:
+            return False
+
+    async def remove_item(self, code: str):
+        """
+        Remove an item from the database
+
+        :return: True if successful deletion
+                 False if deletion failed
+        """
+        item_status = (await self.delete(f'/v2/items/{self.urlencode(code)}')).status_code
+        deleted_status = (await self.get(f'/v2/deleted/{self.urlencode(code)}')).status_code
+        if deleted_status == 200:
+            # Actually deleted
+            return True
+        if item_status == 404 and deleted_status == 404:
+            # ...didn't even exist in the first place? Well, ok...
+            return None  # Tri-state FTW!
+        else:
+            return False
+
+    async def restore_item(self, code: str, location: str):
+        """
+        Restores a deleted item
+
+        :return: True if item successfully restored
+                 False if failed to restore
+        """
+        response = await self.put(f'/v2/deleted/{self.urlencode(code)}/parent', self.codec.dumps(location))
+        return response.status_code == 201
+
+    async def bulk_add(self, upload, identifier: Optional[str] = None, overwrite: bool = False):
+        """
+        Perform a bulk add, to import items from peracotta
+
+        :param upload: The parsed json
+        :param identifier: Optional text to identify the computer
+        :param overwrite: Overwrite if there's a computer with the same identifier
+        :return:
+        """
+        url = '/v2/bulk/add'
+        if identifier:
+            url += '/' + self.urlencode(identifier)
+        if overwrite:
+            url += '?overwrite=true'
+        result = (await self.post(url, self.codec.dumps(upload))).status_code
+        # 409 if is a duplicate
+        return result == 204
+
+    async def travaso(self, code, location):
+        """
+        Move everything inside an item to another location, one item after another like Tarallo.travaso:
+        if a move fails, the items after it are not moved.
+        """
+        item = await self.get_item(code, 1)
+        for inner_item in item.contents:
+            await self.move(inner_item.code, location)
+        return True
+
+    async def get_history(self, code: str, limit: Optional[int] = None):
+        url = f'/v2/items/{self.urlencode(code)}/history'
+        if limit is not None:
+            url += '?length=' + str(int(limit))
+        history = await self.get(url)
+
+        if history.status_code == 200:
+            result = []
+            for entry in self.codec.loads(history.content):
+                try:
+                    change = AuditChanges(entry["change"])
+                except ValueError:
+                    change = AuditChanges.Unknown
+                result.append(AuditEntry(entry["user"], change, float(entry["time"]), entry["other"]))
+            return result
+        elif history.status_code == 404:
+            raise ItemNotFoundError(f"Item {code} doesn\'t exist")
+        else:
+            raise RuntimeError("Unexpected return code")
+
+    async def get_codes_by_feature(self, feature: str, value: str):
+        url = f"/v2/features/{self.urlencode(feature)}/{self.urlencode(value)}"
+        items = await self.get(url)
+
+        if items.status_code == 200:
+            return self.codec.loads(items.content)
+        elif items.status_code == 400:
+            exception = self.codec.loads(items.content)
+            raise ValidationError(exception.get('message', 'No message from the server'))
+        else:
+            raise RuntimeError("Unexpected return code")
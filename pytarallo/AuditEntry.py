@@ -13,6 +13,8 @@ class AuditChanges(Enum):
 
 
 class AuditEntry:
+    __slots__ = ('user', 'change', 'time', 'other')
+
     def __init__(self, user: str, change: AuditChanges, time: float, other: Optional[str] = None):
         self.user = user
         self.change = change
@@ -0,0 +1,55 @@
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec(object):
+    """
+    Encodes requests and decodes responses, with the json module from the standard library.
+
+    Subclass it to use another JSON library, loads receives the body of responses as bytes and dumps must
+    return bytes (or str).
+    """
+    name = 'json'
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        # Bytes are fine, no need to decode them first
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    orjson, several times faster than the standard library. Install it with pip install "pytarallo[fast]".
+    """
+    name = 'orjson'
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+
+def get_codec(codec: Union[str, JsonCodec, None] = None) -> JsonCodec:
+    """
+    Choose a codec
+
+    :param codec: A codec, or the name of one ("json" or "orjson"), or None for the fastest one installed.
+                  If orjson is not installed, the standard library is used instead.
+    """
+    if isinstance(codec, JsonCodec):
+        return codec
+    if codec is None:
+        codec = OrjsonCodec.name
+    if codec == OrjsonCodec.name:
+        return OrjsonCodec() if orjson is not None else JsonCodec()
+    if codec == JsonCodec.name:
+        return JsonCodec()
+    raise ValueError(f"Unknown codec {codec}")
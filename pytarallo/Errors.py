@@ -55,6 +55,29 @@ class ServerError(Exception):
     pass
 
 
+class CircuitOpenError(ServerError):
+    """
+    When the server has failed too many times in a row, and the CircuitBreaker isn't even trying anymore.
+    """
+    pass
+
+
+class RequestTimeoutError(Exception):
+    """
+    When the server takes longer than the read timeout to answer.
+    """
+    pass
+
+
+class DeadlineExceededError(RequestTimeoutError):
+    """
+    When an operation, with all its requests and retries, takes longer than the deadline.
+
+    E.g. a travaso with too many items to move, a get_item stuck on a slow server, etc...
+    """
+    pass
+
+
 class InvalidObjectError(Exception):
     """
     Object can be an Item, a Product, or other.
@@ -0,0 +1,582 @@
+import email.utils
+import gzip
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Optional, Dict, Any, List, Tuple, Iterable
+
+
+class _Item(object):
+    def __init__(self, code: str, features: Dict[str, Any], product: Optional[Tuple[str, str, str]] = None):
+        self.code = code
+        self.features = features
+        self.product = product
+        self.parent: Optional["_Item"] = None
+        self.contents: List["_Item"] = []
+        self.history: List[dict] = []
+        self.deleted: Optional[float] = None
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients that time out close the connection before the answer, that's expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server: _ThreadingHTTPServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.fake.handle(self)
+
+    def do_PUT(self):
+        self.server.fake.handle(self)
+
+    def do_POST(self):
+        self.server.fake.handle(self)
+
+    def do_PATCH(self):
+        self.server.fake.handle(self)
+
+    def do_DELETE(self):
+        self.server.fake.handle(self)
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    # Trailers, until an empty line
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            body = bytes(body)
+        else:
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length > 0 else b''
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def reply(self, status: int, body: Any = None, headers: Optional[Dict[str, str]] = None):
+        """
+        :param body: Anything that can be serialized to JSON, or bytes that are already serialized
+        """
+        if body is None or isinstance(body, bytes):
+            content = b'' if body is None else body
+        else:
+            content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class FakeServer(object):
+    """
+    In-process stand-in for a T.A.R.A.L.L.O. server, for offline tests and benchmarks.
+
+    It implements the endpoints used by Tarallo and AsyncTarallo on a synthetic inventory: a "Warehouse"
+    root with shelves full of computers, each one containing a motherboard, a CPU, two RAMs and a HDD.
+    Features are not validated against the real features list, only a few obvious mistakes are rejected.
+
+        with FakeServer(computers=100) as server:
+            tarallo = Tarallo(server.url, server.token)
+            tarallo.get_item('PC1')
+
+    Latency and errors can be injected with the latency and error_rate attributes, or fail_next().
+
+    Successful GETs have an ETag, and a Last-Modified which is the same for every URL: the time of the last
+    change to anything. It moves forward by at least one second at each change, since HTTP dates have no
+    fractions of a second. Conditional requests get a 304.
+    """
+
+    ROOT = 'Warehouse'
+    USER = 'fake'
+
+    def __init__(self, computers: int = 10, computers_per_shelf: int = 10, token: str = 'fake-token',
+                 latency: float = 0.0, error_rate: float = 0.0, error_status: int = 500, seed: int = 0,
+                 host: str = '127.0.0.1', port: int = 0, validators: Iterable[str] = ('ETag', 'Last-Modified')):
+        """
+        :param computers: Number of computers in the synthetic inventory, 6 items each
+        :param computers_per_shelf: How many computers are placed on each shelf
+        :param token: Token accepted by the server, anything else gets a 401
+        :param latency: Seconds to wait before answering each request
+        :param error_rate: Probability of answering a request with error_status instead
+        :param error_status: Status code for injected errors
+        :param seed: Seed for the random generator, so that inventories and errors can be reproduced
+        :param host: Address to listen on
+        :param port: Port to listen on, 0 to choose a free one
+        :param validators: Which validators to send in responses: ETag, Last-Modified, both or none
+        """
+        self.token = token
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.request_count = 0
+        self.log = deque(maxlen=1000)
+        self.validators = frozenset(validators)
+        self.last_modified = int(time.time())
+
+        self.__random = random.Random(seed)
+        self.__lock = threading.RLock()
+        self.__items: Dict[str, _Item] = {}
+        self.__products: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self.__bulk: Dict[str, Any] = {}
+        self.__failures = deque()
+        self.__counters: Dict[str, int] = {}
+
+        self.__server = _ThreadingHTTPServer((host, port), _Handler)
+        self.__server.fake = self
+        self.__thread: Optional[threading.Thread] = None
+
+        self.__populate(computers, computers_per_shelf)
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__server.serve_forever, args=(0.05,), daemon=True)
+            self.__thread.start()
+        return self
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__server.shutdown()
+            self.__thread.join()
+            self.__thread = None
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def fail_next(self, count: int = 1, status: Optional[int] = 500):
+        """
+        Answer the next count requests with this status, or drop the connection without answering if None
+        """
+        with self.__lock:
+            self.__failures.extend([status] * count)
+
+    # Inventory management, to set up tests
+
+    def add_item(self, code: str, features: Dict[str, Any], parent: Optional[str] = None,
+                 product: Optional[Tuple[str, str, str]] = None) -> str:
+        with self.__lock:
+            item = _Item(code, dict(features), product)
+            self.__items[self.__key(code)] = item
+            if parent is not None:
+                self.__place(item, self.__items[self.__key(parent)])
+            self.__record(item, 'C')
+            return code
+
+    def add_product(self, brand: str, model: str, variant: str, features: Dict[str, Any]):
+        with self.__lock:
+            self.__products[(brand, model, variant)] = dict(features)
+
+    def codes(self) -> List[str]:
+        """
+        Codes of every item, except deleted ones
+        """
+        with self.__lock:
+            return [item.code for item in self.__items.values() if item.deleted is None]
+
+    def bulk_uploads(self) -> Dict[str, Any]:
+        """
+        Everything received by bulk add, identifier -> upload
+        """
+        with self.__lock:
+            return dict(self.__bulk)
+
+    def __populate(self, computers: int, computers_per_shelf: int):
+        rams = [('Samsung', f'M3 78T{n}', 'default') for n in range(8)]
+        cpus = [('Intel', f'Core 2 Duo E{8200 + n * 100}', 'default') for n in range(4)]
+        for brand, model, variant in rams:
+            self.add_product(brand, model, variant, {'type': 'ram', 'capacity-byte': 1073741824, 'color': 'green'})
+        for brand, model, variant in cpus:
+            self.add_product(brand, model, variant, {'type': 'cpu', 'core-n': 2, 'cpu-socket': 'lga775'})
+
+        self.add_item(self.ROOT, {'type': 'location'})
+        shelf = None
+        for n in range(1, computers + 1):
+            if (n - 1) % computers_per_shelf == 0:
+                shelf = self.add_item(f'Shelf{(n - 1) // computers_per_shelf + 1}', {'type': 'location'}, self.ROOT)
+            pc = self.add_item(f'PC{n}', {'type': 'case', 'working': 'yes', 'color': 'black'}, shelf)
+            self.add_item(f'B{n}', {'type': 'motherboard', 'working': 'yes', 'sn': f'MB{n:06}'}, pc)
+            self.add_item(f'C{n}', {'type': 'cpu', 'working': 'yes'}, pc, self.__random.choice(cpus))
+            for r in range(2):
+                self.add_item(f'R{n * 2 - 1 + r}', {'type': 'ram', 'working': self.__random.choice(['yes', 'no']),
+                                                     'sn': f'RAM{n:06}{r}'}, pc, self.__random.choice(rams))
+            self.add_item(f'H{n}', {'type': 'hdd', 'working': 'yes', 'capacity-byte': 160000000000}, pc)
+
+    @staticmethod
+    def __key(code: str) -> str:
+        return code.upper()
+
+    def __find(self, code: str) -> Optional[_Item]:
+        item = self.__items.get(self.__key(code))
+        if item is None or item.deleted is not None:
+            return None
+        return item
+
+    def __record(self, item: _Item, change: str, other: Optional[str] = None):
+        item.history.append({'user': self.USER, 'change': change, 'time': f'{time.time():.6f}', 'other': other})
+
+    @staticmethod
+    def __place(item: _Item, parent: Optional[_Item]):
+        if item.parent is not None:
+            item.parent.contents.remove(item)
+        item.parent = parent
+        if parent is not None:
+            parent.contents.append(item)
+
+    @staticmethod
+    def __path(item: _Item) -> List[str]:
+        path = []
+        parent = item.parent
+        while parent is not None:
+            path.append(parent.code)
+            parent = parent.parent
+        path.reverse()
+        return path
+
+    def __serialize(self, item: _Item, depth: Optional[int], top_level: bool = True) -> dict:
+        result = {'code': item.code, 'features': item.features if len(item.features) > 0 else []}
+        if item.product is not None:
+            brand, model, variant = item.product
+            result['product'] = {'brand': brand, 'model': model, 'variant': variant,
+                                 'features': self.__products.get(item.product, [])}
+        if top_level:
+            result['location'] = self.__path(item)
+        if len(item.contents) > 0 and (depth is None or depth > 0):
+            inner_depth = None if depth is None else depth - 1
+            result['contents'] = [self.__serialize(inner, inner_depth, False) for inner in item.contents]
+        return result
+
+    def __generate_code(self, features: Dict[str, Any]) -> str:
+        prefix = str(features.get('type', 'X'))[0].upper()
+        while True:
+            self.__counters[prefix] = self.__counters.get(prefix, 1000) + 1
+            code = f'{prefix}{self.__counters[prefix]}'
+            if self.__key(code) not in self.__items:
+                return code
+
+    # Request handling
+
+    def handle(self, request: _Handler):
+        with self.__lock:
+            self.request_count += 1
+            self.log.append((request.command, request.path))
+            failure = self.__failures.popleft() if len(self.__failures) > 0 else False
+            if failure is False and self.error_rate > 0 and self.__random.random() < self.error_rate:
+                failure = self.error_status
+        body = request.read_body()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if failure is None:
+            request.close_connection = True
+            return
+        if failure is not False:
+            request.reply(failure, {'message': 'Injected error'})
+            return
+        if request.headers.get('Authorization') != 'Token ' + self.token:
+            request.reply(401, {'message': 'Not authenticated'})
+            return
+
+        url = urllib.parse.urlsplit(request.path)
+        path = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/')]
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        if len(body) > 0:
+            try:
+                body = json.loads(body)
+            except ValueError:
+                request.reply(400, {'message': 'Invalid JSON'})
+                return
+        else:
+            body = None
+        with self.__lock:
+            status, response = self.__route(request.command, path, query, body)
+            if request.command != 'GET' and status < 400:
+                self.last_modified = max(int(time.time()), self.last_modified + 1)
+            last_modified = self.last_modified
+        if request.command == 'GET' and status == 200 and len(self.validators) > 0:
+            self.__reply_validated(request, response, last_modified)
+        else:
+            request.reply(status, response)
+
+    def __reply_validated(self, request: _Handler, response: Any, last_modified: int):
+        """
+        Reply with validators, or with a 304 if the client already has this response
+        """
+        content = json.dumps(response).encode('utf-8')
+        headers = {}
+        if 'ETag' in self.validators:
+            headers['ETag'] = '"' + hashlib.sha1(content).hexdigest() + '"'
+        if 'Last-Modified' in self.validators:
+            headers['Last-Modified'] = email.utils.formatdate(last_modified, usegmt=True)
+
+        if_none_match = request.headers.get('If-None-Match')
+        if_modified_since = request.headers.get('If-Modified-Since')
+        not_modified = False
+        if if_none_match is not None:
+            # If-Modified-Since is ignored when there's an If-None-Match
+            not_modified = 'ETag' in headers and headers['ETag'] in [tag.strip() for tag in if_none_match.split(',')]
+        elif if_modified_since is not None and 'Last-Modified' in headers:
+            try:
+                not_modified = email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= last_modified
+            except (TypeError, ValueError):
+                pass
+        if not_modified:
+            request.reply(304, None, headers)
+        else:
+            request.reply(200, content, headers)
+
+    def __route(self, method: str, path: List[str], query: Dict[str, List[str]], body: Any) -> Tuple[int, Any]:
+        if len(path) < 2 or path[0] != 'v2':
+            return 404, {'message': 'Not found'}
+        endpoint = path[1]
+        args = path[2:]
+        if endpoint == 'session' and method == 'GET':
+            return 200, {'username': self.USER}
+        if endpoint == 'items':
+            return self.__route_items(method, args, query, body)
+        if endpoint == 'deleted' and len(args) >= 1:
+            return self.__route_deleted(method, args, body)
+        if endpoint == 'products' and len(args) >= 2:
+            return self.__route_products(method, args, body)
+        if endpoint == 'bulk' and len(args) >= 1 and args[0] == 'add' and method == 'POST':
+            return self.__bulk_add(args[1] if len(args) > 1 else None, query.get('overwrite') == ['true'], body)
+        if endpoint == 'features' and len(args) == 2 and method == 'GET':
+            return self.__codes_by_feature(args[0], args[1])
+        return 404, {'message': 'Not found'}
+
+    def __route_items(self, method: str, args: List[str], query: Dict[str, List[str]], body: Any):
+        if len(args) == 0:
+            if method == 'POST':
+                return self.__create(None, body)
+            return 405, {'message': 'Method not allowed'}
+        code = args[0]
+        if len(args) == 1:
+            if method == 'GET':
+                item = self.__find(code)
+                if item is None:
+                    return 404, {'item': code}
+                depth = int(query['depth'][0]) if 'depth' in query else None
+                return 200, self.__serialize(item, depth)
+            if method == 'PUT':
+                return self.__create(code, body)
+            if method == 'DELETE':
+                return self.__delete(code)
+        elif args[1] == 'parent':
+            if method == 'PUT':
+                return self.__move(code, body)
+            if method == 'DELETE':
+                return self.__lose(code)
+        elif args[1] == 'features' and method == 'PATCH':
+            return self.__update_features(code, body)
+        elif args[1] == 'history' and method == 'GET':
+            item = self.__find(code)
+            if item is None:
+                return 404, {'item': code}
+            length = int(query['length'][0]) if 'length' in query else 20
+            return 200, list(reversed(item.history))[:length]
+        return 405, {'message': 'Method not allowed'}
+
+    def __create(self, code: Optional[str], body: Any) -> Tuple[int, Any]:
+        if not isinstance(body, dict) or not isinstance(body.get('features'), dict):
+            return 400, {'message': 'Invalid item'}
+        # Check everything before creating anything
+        codes = []
+        stack = [(body, code)]
+        while len(stack) > 0:
+            data, data_code = stack.pop()
+            if data_code is not None:
+                if not re.fullmatch(r'[A-Za-z0-9\-_]+', data_code) or self.__key(data_code) in self.__items:
+                    return 400, {'message': f'Invalid code {data_code}'}
+                codes.append(data_code)
+            for inner in data.get('contents', []):
+                stack.append((inner, inner.get('code')))
+        if len(set(map(self.__key, codes))) != len(codes):
+            return 400, {'message': 'Duplicate codes'}
+        parent = None
+        if body.get('parent') is not None:
+            parent = self.__find(body['parent'])
+            if parent is None:
+                return 404, {'item': body['parent']}
+
+        stack = [(body, code, parent)]
+        root_code = None
+        while len(stack) > 0:
+            data, data_code, data_parent = stack.pop()
+            if data_code is None:
+                data_code = self.__generate_code(data.get('features', {}))
+            item = _Item(data_code, dict(data.get('features', {})))
+            self.__items[self.__key(data_code)] = item
+            self.__place(item, data_parent)
+            self.__record(item, 'C')
+            if root_code is None:
+                root_code = data_code
+            for inner in data.get('contents', []):
+                stack.append((inner, inner.get('code'), item))
+        return 201, root_code
+
+    def __delete(self, code: str) -> Tuple[int, Any]:
+        item = self.__find(code)
+        if item is None:
+            return 404, {'item': code}
+        if len(item.contents) > 0:
+            return 400, {'message': f'{code} is not empty'}
+        self.__place(item, None)
+        item.deleted = time.time()
+        self.__record(item, 'D')
+        return 204, None
+
+    def __move(self, code: str, location: Any) -> Tuple[int, Any]:
+        item = self.__find(code)
+        if item is None:
+            return 404, {'item': code}
+        if not isinstance(location, str) or self.__find(location) is None:
+            return 404, {'item': location}
+        parent = self.__find(location)
+        ancestor = parent
+        while ancestor is not None:
+            if ancestor is item:
+                return 400, {'message': f'Cannot move {code} inside itself'}
+            ancestor = ancestor.parent
+        item_type = item.features.get('type')
+        parent_type = parent.features.get('type')
+        if parent_type != 'location' and (item_type == 'location' or parent_type != 'case'):
+            return 400, {'message': f'Cannot place {code} inside {location}'}
+        self.__place(item, parent)
+        self.__record(item, 'M', parent.code)
+        return 200, {'from': None, 'to': parent.code}
+
+    def __lose(self, code: str) -> Tuple[int, Any]:
+        item = self.__find(code)
+        if item is None:
+            return 404, {'item': code}
+        if item.parent is None:
+            return 400, {'message': f'{code} is already lost'}
+        self.__place(item, None)
+        self.__record(item, 'L')
+        return 204, None
+
+    def __update_features(self, code: str, features: Any) -> Tuple[int, Any]:
+        item = self.__find(code)
+        if item is None:
+            return 404, {'item': code}
+        if not isinstance(features, dict) or len(features) == 0:
+            return 400, {'message': 'No features to update'}
+        self.__patch(item.features, features)
+        self.__record(item, 'U')
+        return 204, None
+
+    @staticmethod
+    def __patch(features: Dict[str, Any], changes: Dict[str, Any]):
+        for name, value in changes.items():
+            if value is None:
+                features.pop(name, None)
+            else:
+                features[name] = value
+
+    def __route_deleted(self, method: str, args: List[str], body: Any) -> Tuple[int, Any]:
+        item = self.__items.get(self.__key(args[0]))
+        if item is None or item.deleted is None:
+            return 404, {'item': args[0]}
+        if len(args) == 1 and method == 'GET':
+            return 200, item.deleted
+        if len(args) == 2 and args[1] == 'parent' and method == 'PUT':
+            parent = self.__find(body) if isinstance(body, str) else None
+            if parent is None:
+                return 404, {'item': body}
+            item.deleted = None
+            self.__place(item, parent)
+            self.__record(item, 'M', parent.code)
+            return 201, None
+        return 405, {'message': 'Method not allowed'}
+
+    def __route_products(self, method: str, args: List[str], body: Any) -> Tuple[int, Any]:
+        if len(args) == 2 and method == 'GET':
+            products = [{'brand': key[0], 'model': key[1], 'variant': key[2], 'features': features}
+                        for key, features in self.__products.items() if key[:2] == tuple(args)]
+            if len(products) == 0:
+                return 404, {'message': 'Product not found'}
+            return 200, products
+        if len(args) < 3:
+            return 405, {'message': 'Method not allowed'}
+        key = (args[0], args[1], args[2])
+        if len(args) == 3:
+            if method == 'GET':
+                if key not in self.__products:
+                    return 404, {'message': 'Product not found'}
+                return 200, {'brand': key[0], 'model': key[1], 'variant': key[2], 'features': self.__products[key]}
+            if method == 'PUT':
+                if key in self.__products or not isinstance(body, dict):
+                    return 400, {'message': 'Product already exists'}
+                self.__products[key] = dict(body.get('features', {}))
+                return 201, None
+            if method == 'DELETE':
+                if self.__products.pop(key, None) is None:
+                    return 404, {'message': 'Product not found'}
+                return 204, None
+        elif args[3] == 'features' and method == 'PATCH':
+            if key not in self.__products:
+                return 404, {'message': 'Product not found'}
+            if not isinstance(body, dict) or len(body) == 0:
+                return 400, {'message': 'No features to update'}
+            self.__patch(self.__products[key], body)
+            return 204, None
+        return 405, {'message': 'Method not allowed'}
+
+    def __bulk_add(self, identifier: Optional[str], overwrite: bool, body: Any) -> Tuple[int, Any]:
+        if not isinstance(body, list):
+            return 400, {'message': 'Invalid upload'}
+        if identifier is None:
+            identifier = f'upload-{len(self.__bulk) + 1}'
+        elif identifier in self.__bulk and not overwrite:
+            return 409, {'message': f'{identifier} already exists'}
+        self.__bulk[identifier] = body
+        return 204, None
+
+    def __codes_by_feature(self, feature: str, value: str) -> Tuple[int, Any]:
+        known = False
+        codes = []
+        for item in self.__items.values():
+            if item.deleted is None and feature in item.features:
+                known = True
+                if isinstance(item.features[feature], float):
+                    return 400, {'message': f'Cannot search {feature}, it is a floating point number'}
+                if str(item.features[feature]) == value:
+                    codes.append(item.code)
+        if not known:
+            return 400, {'message': f'Unknown feature {feature}'}
+        return 200, codes
@@ -0,0 +1,127 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Union, Callable
+
+from .Tarallo import Tarallo
+
+FlushResults = Dict[str, Union[bool, None, Exception]]
+
+
+class FeatureBuffer(object):
+    """
+    Write-behind buffer for Tarallo.update_item_features.
+
+    Updates to the same item are merged until the buffer is flushed, then sent as a single PATCH per item:
+    later values overwrite earlier ones, None deletes the feature as usual. The buffer is flushed when it
+    holds max_items items, max_delay seconds after the first pending update, on flush() or when closed.
+
+    Flushes happen one at a time, so updates to the same item are always applied in order. Failed updates
+    are not retried, they're reported in the results of the flush. Results of automatic flushes go to on_flush,
+    or if there's none, their failures are added to the results of the next flush() or close().
+    """
+
+    def __init__(self, tarallo: Tarallo, max_items: int = 100, max_delay: Optional[float] = 5.0,
+                 max_workers: int = 8, on_flush: Optional[Callable[[FlushResults], None]] = None):
+        """
+        :param tarallo: Session to send updates with
+        :param max_items: Flush when this many items have pending updates
+        :param max_delay: Flush this many seconds after the first pending update, None to flush only explicitly
+                          or when max_items is reached
+        :param max_workers: Items to update concurrently during a flush
+        :param on_flush: Called with the results of every flush, including automatic ones
+        """
+        if max_items <= 0:
+            raise ValueError("max_items must be positive")
+        self.tarallo = tarallo
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.max_workers = max_workers
+        self.on_flush = on_flush
+        # Normalized code -> (code, merged features)
+        self.__pending: Dict[str, tuple] = {}
+        self.__timer: Optional[threading.Timer] = None
+        # Of automatic flushes, when there's no on_flush to report them to
+        self.__failures: Dict[str, Exception] = {}
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def update_item_features(self, code: str, features: dict):
+        """
+        Same as Tarallo.update_item_features, but buffered. Errors are reported when the buffer is flushed.
+        """
+        with self.__lock:
+            # The server doesn't care about case, updates to "r1" and "R1" must be merged
+            key = code.upper()
+            if key in self.__pending:
+                self.__pending[key][1].update(features)
+            else:
+                self.__pending[key] = (code, dict(features))
+            full = len(self.__pending) >= self.max_items
+            if not full and self.__timer is None and self.max_delay is not None:
+                self.__timer = threading.Timer(self.max_delay, self.__flush, (False,))
+                self.__timer.daemon = True
+                self.__timer.start()
+        if full:
+            self.__flush(False)
+
+    def pending(self) -> Dict[str, dict]:
+        """
+        Updates that haven't been sent yet, code -> features
+        """
+        with self.__lock:
+            return {code: dict(features) for code, features in self.__pending.values()}
+
+    def flush(self) -> FlushResults:
+        """
+        Send all pending updates, one PATCH per item
+
+        :return: code -> what update_item_features returned (True), or the exception it raised. Failures of
+                 automatic flushes since the last flush() are here too, and take precedence over later results
+                 for the same item: the features of the failed update haven't been sent anyway.
+        """
+        return self.__flush(True)
+
+    def __flush(self, explicit: bool) -> FlushResults:
+        with self.__flush_lock:
+            with self.__lock:
+                pending = list(self.__pending.values())
+                self.__pending = {}
+                if self.__timer is not None:
+                    self.__timer.cancel()
+                    self.__timer = None
+            results = {}
+            if len(pending) > 0:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+                    for code, result in zip((code for code, _ in pending),
+                                            executor.map(lambda update: self.__update(*update), pending)):
+                        results[code] = result
+            if explicit:
+                results.update(self.__failures)
+                self.__failures = {}
+            elif self.on_flush is None:
+                self.__failures.update((code, result) for code, result in results.items()
+                                       if isinstance(result, Exception))
+        if self.on_flush is not None:
+            self.on_flush(results)
+        return results
+
+    def __update(self, code: str, features: dict) -> Union[bool, None, Exception]:
+        try:
+            return self.tarallo.update_item_features(code, features)
+        except Exception as e:
+            return e
+
+    def close(self) -> FlushResults:
+        """
+        Flush everything, the buffer can still be used afterwards
+        """
+        return self.flush()
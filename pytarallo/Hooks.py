@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import deque
+from typing import Optional, Dict, Any, List
+
+import requests
+
+
+class Span(object):
+    """
+    A timed piece of work: a call to an operation of Tarallo, e.g. travaso, or a single request.
+
+    Operations and requests started during an operation are its children, so a travaso has a get_item
+    child, with its request as a child, followed by a move child for each item.
+    """
+    __slots__ = ('name', 'parent', 'attributes', 'children', 'start_time', 'duration', 'error', '__start')
+
+    def __init__(self, name: str, parent: Optional['Span'] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.parent = parent
+        self.attributes: Dict[str, Any] = {} if attributes is None else attributes
+        self.children: List[Span] = []
+        # Unix timestamp, for tracing backends
+        self.start_time = time.time()
+        # In seconds, None until it ends
+        self.duration: Optional[float] = None
+        self.error: Optional[Exception] = None
+        self.__start = time.perf_counter()
+        if parent is not None:
+            parent.children.append(self)
+
+    def finish(self, error: Optional[Exception] = None):
+        self.duration = time.perf_counter() - self.__start
+        self.error = error
+
+    def __str__(self):
+        lines = []
+        stack = [(self, 0)]
+        while len(stack) > 0:
+            span, level = stack.pop()
+            duration = '...' if span.duration is None else f'{span.duration * 1000:.1f} ms'
+            error = '' if span.error is None else f' ({type(span.error).__name__})'
+            lines.append(f"{'  ' * level}{span.name} {duration}{error}")
+            stack.extend((child, level + 1) for child in reversed(span.children))
+        return '\n'.join(lines)
+
+
+class Hooks(object):
+    """
+    Callbacks for the lifecycle of the operations and requests of Tarallo, e.g. to send spans to a
+    tracing backend. Override the methods you need and pass an instance to Tarallo.
+    """
+
+    def start_span(self, span: Span):
+        """
+        An operation or a request is starting
+        """
+        pass
+
+    def end_span(self, span: Span):
+        """
+        An operation or a request has ended, successfully or not
+        """
+        pass
+
+    def before_request(self, span: Span, method: str, url: str, headers: Dict[str, str]):
+        """
+        A request is about to be sent. Headers can be modified, e.g. to propagate the trace to the server.
+        Retries are sent as new requests, each one with its span.
+        """
+        pass
+
+    def after_response(self, span: Span, response: requests.Response):
+        """
+        A response has been received, whatever its status code
+        """
+        pass
+
+    def on_error(self, span: Span, error: Exception):
+        """
+        An operation raised an exception, or a request got no response (e.g. the connection dropped)
+        """
+        pass
+
+
+class SpanRecorder(Hooks):
+    """
+    Keeps the spans of the last operations, to see where time goes:
+
+        recorder = SpanRecorder()
+        tarallo = Tarallo(url, token, hooks=[recorder])
+        tarallo.travaso('PC42', 'Shelf1')
+        print(recorder.spans[-1])
+    """
+
+    def __init__(self, max_spans: int = 100):
+        """
+        :param max_spans: How many spans to keep, only the outermost ones count
+        """
+        self.spans = deque(maxlen=max_spans)
+        self.__lock = threading.Lock()
+
+    def end_span(self, span: Span):
+        if span.parent is None:
+            with self.__lock:
+                self.spans.append(span)
@@ -1,24 +1,48 @@
-from typing import Optional, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, Union
 
-from .Errors import InvalidObjectError
+from .Errors import InvalidObjectError, ServerError
 from .ItemBase import ItemBase
 from .Product import Product
+from .ProductRegistry import ProductRegistry
 
 
 class Item(ItemBase):
+    __slots__ = ('location', 'product', '_loader')
     code: str
-    location: List[str]
+    location: Optional[List[str]]
     product: Optional[Product]
 
-    def __init__(self, data: dict, top_level: bool = True):
+    def __init__(self, data: dict, top_level: bool = True, products: Optional[ProductRegistry] = None):
         """
         Items are created by the get_item method
         params: data: a dict() containing the item's data.
 
-        :top_level: Used for recursion, set to True when calling from outside
+        :top_level: Set to True when calling from outside, False for items inside other items
+        :products: Optional registry, to share the same Product instance between items
         """
         super().__init__()
+        self.__load(data, top_level, products)
 
+        # load the optional list of items (content) of the item from data.
+        # This is done with a stack instead of recursion, so that very deep trees don't hit the recursion limit
+        stack = [(self, data)]
+        while len(stack) > 0:
+            item, item_data = stack.pop()
+            if item_data.get('contents'):
+                for inner_item_data in item_data['contents']:
+                    inner_item = Item.__new__(Item)
+                    ItemBase.__init__(inner_item)
+                    inner_item.__load(inner_item_data, False, products)
+                    item._contents.append(inner_item)
+                    if inner_item_data.get('contents'):
+                        stack.append((inner_item, inner_item_data))
+
+    def __load(self, data: dict, top_level: bool, products: Optional[ProductRegistry]):
+        """
+        Load everything except contents
+        """
         # setup path and location
         # location: the most specific position where the item is located, e.g. "Table"
         # path: a list representing the hierarchy of locations the item, e.g. ["Polito", "Chernobyl", "Table"]
@@ -30,18 +54,17 @@ class Item(ItemBase):
             raise InvalidObjectError("Received item without code")
 
         if data.get('product'):
-            self.product = Product(data['product'])
+            if products is None:
+                self.product = Product(data['product'])
+            else:
+                self.product = products.resolve(data['product'])
         else:
             self.product = None
 
         # it's an empty *list* if there are no features,
         # since empty dict and list are the same on the server.
-        # We need to check for lenght because list doesn't have items()
-        # and would throw an error otherwise.
-        if len(data['features']) > 0:
-            for k, v in data['features'].items():
-                # setattr(self, k, v)
-                self.features[k] = v
+        # dict() handles both.
+        self.features = dict(data['features'])
 
         if top_level:
             if data.get('location'):
@@ -51,11 +74,45 @@ class Item(ItemBase):
         else:
             if data.get('location'):
                 raise InvalidObjectError("Location is set for a not top level item")
+            # Only the top level item knows its location
+            self.location = None
+
+        # Contents are all there, unless ItemLoader.make_lazy says otherwise
+        self._loader = None
 
-        # load the optional list of items (content) of the item from data
-        if data.get('contents'):
-            for inner_item_data in data.get('contents'):
-                self.add_content(Item(inner_item_data, False))
+    @property
+    def contents(self) -> List["Item"]:
+        """
+        Items inside this one. For lazy items, they are fetched from the server the first time they're needed.
+        """
+        if self._loader is not None:
+            self._loader.load(self)
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents: List["Item"]):
+        # In this order, or another thread could see an item that is loaded but still has no contents
+        self._contents = contents
+        self._loader = None
+
+    @property
+    def loaded(self) -> bool:
+        """
+        False for lazy items whose contents haven't been fetched yet
+        """
+        return self._loader is None
+
+    def load_all(self, max_workers: int = 8):
+        """
+        Fetch the contents of every lazy item inside this one, at any depth. All the lazy items at the same
+        depth are fetched at the same time, instead of one after another as a walk of the tree reaches them.
+        Cloning, serializing, printing, indexing or diffing the tree call this first.
+
+        :param max_workers: Maximum number of requests in flight at the same time
+        :raises Exception: The first error of a level, after everything else in that level has been loaded.
+                           Items that couldn't be loaded stay lazy.
+        """
+        ItemLoader.load_all(self, max_workers)
 
     def add_content(self, item):
         """
@@ -65,16 +122,142 @@ class Item(ItemBase):
             raise InvalidObjectError("Item can only contain another Item")
         self.contents.append(item)
 
-    def serializable(self) -> dict:
-        result = super().serializable()
-        result['location'] = self.location
+    def _serializable_node(self) -> dict:
+        result = super()._serializable_node()
+        if self.location is not None:
+            result['location'] = self.location
         if self.product:
             result['product'] = self.product.serializable()
         return result
 
+    def serializable(self) -> dict:
+        self.load_all()
+        return super().serializable()
+
     def __str__(self):
-        s = str(self.features)
-        for e in self.contents:
-            s = s + "\n"
-            s = s + str(e)
-        return s
+        # Features of this item and everything inside it, depth first, one per line
+        self.load_all()
+        lines = []
+        stack = [self]
+        while len(stack) > 0:
+            item = stack.pop()
+            lines.append(str(item.features))
+            stack.extend(reversed(item.contents))
+        return "\n".join(lines)
+
+
+class ItemLoader(object):
+    """
+    Fetches the contents of lazy items, which are the ones at the depth_limit of get_item(..., lazy=True).
+
+    Each loader is shared by the lazy items inside the same item, so that they can be fetched all at once.
+    """
+    __slots__ = ('tarallo', 'depth_limit', 'prefetch_siblings', 'siblings', 'lock')
+
+    def __init__(self, tarallo, depth_limit: int, prefetch_siblings: bool):
+        """
+        :param tarallo: The Tarallo session to use
+        :param depth_limit: Depth to fetch each time, at least 1
+        :param prefetch_siblings: Also fetch all the other items with this loader, concurrently, when one is needed
+        """
+        self.tarallo = tarallo
+        self.depth_limit = max(depth_limit, 1)
+        self.prefetch_siblings = prefetch_siblings
+        self.siblings: List[Item] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_lazy(item: Item, tarallo, depth_limit: int, prefetch_siblings: bool = False):
+        """
+        Mark every item at depth_limit as lazy, since the server didn't send their contents
+        """
+        if depth_limit <= 0:
+            item._loader = ItemLoader(tarallo, depth_limit, prefetch_siblings)
+            item._loader.siblings.append(item)
+            return
+        stack = [(item, 0)]
+        while len(stack) > 0:
+            current, depth = stack.pop()
+            if depth + 1 < depth_limit:
+                for inner_item in current._contents:
+                    stack.append((inner_item, depth + 1))
+            elif len(current._contents) > 0:
+                loader = ItemLoader(tarallo, depth_limit, prefetch_siblings)
+                for inner_item in current._contents:
+                    inner_item._loader = loader
+                    loader.siblings.append(inner_item)
+
+    def load(self, item: Item):
+        with self.lock:
+            if item._loader is not self:
+                # Another thread got here first
+                return
+            if self.prefetch_siblings:
+                pending = [sibling for sibling in self.siblings if sibling._loader is self]
+            else:
+                pending = [item]
+            results = self.__fetch_all([(sibling, self) for sibling in pending], 8)
+            error = None
+            for sibling, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    # Siblings stay lazy, they will fail again when (and if) someone needs them
+                    if sibling is item:
+                        error = result
+                else:
+                    sibling.contents = result._contents
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def load_all(item: Item, max_workers: int):
+        """
+        Same as Item.load_all
+        """
+        stack = [item]
+        while len(stack) > 0:
+            # Lazy items of the next level, without loading anything
+            pending = []
+            while len(stack) > 0:
+                current = stack.pop()
+                loader = current._loader
+                if loader is None:
+                    stack.extend(current._contents)
+                else:
+                    pending.append((current, loader))
+            errors = []
+            for (current, loader), result in zip(pending, ItemLoader.__fetch_all(pending, max_workers)):
+                if isinstance(result, Exception):
+                    errors.append(result)
+                    continue
+                with loader.lock:
+                    if current._loader is loader:
+                        current.contents = result._contents
+                # Walk it in the next round, its contents may be lazy too
+                stack.append(current)
+            if len(errors) > 0:
+                raise errors[0]
+
+    @staticmethod
+    def __fetch_all(pending: List[Tuple[Item, "ItemLoader"]], max_workers: int) -> List[Union[Item, Exception]]:
+        """
+        Fetch these items again, each with its own loader, concurrently. The items aren't changed.
+
+        :return: For each item, the fetched one, or the exception raised while fetching it
+        """
+        if len(pending) <= 1:
+            return [loader.__fetch(item) for item, loader in pending]
+        # Tarallo imports this module, it can't be imported at the top
+        from .Tarallo import _submit
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [_submit(executor, loader.__fetch, item) for item, loader in pending]
+            return [future.result() for future in futures]
+
+    def __fetch(self, item: Item) -> Union[Item, Exception]:
+        try:
+            result = self.tarallo.get_item(item.code, self.depth_limit, True, self.prefetch_siblings)
+        except Exception as e:
+            return e
+        if result is None:
+            # The server answered with something other than the item or a 404
+            return ServerError(f"Contents of {item.code} not received")
+        return result
@@ -5,9 +5,10 @@ class ItemBase:
     """
     Base class, do not use directly, use Item or ItemToUpload instead
     """
+    # No __dict__, items can be tens of thousands
+    __slots__ = ('code', 'features', '_contents')
     code: Optional[str]
     features: Dict[str, Any]
-    contents: List[Any]
 
     def __init__(self):
         """
@@ -16,18 +17,39 @@ class ItemBase:
         """
         self.code = None
         self.features = {}
-        self.contents = list()
+        self._contents = list()
+
+    @property
+    def contents(self) -> List[Any]:
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents: List[Any]):
+        self._contents = contents
 
     def serializable(self) -> dict:
+        result = self._serializable_node()
+        # No recursion, very deep trees would hit the recursion limit
+        stack = [(self.contents, result)]
+        while len(stack) > 0:
+            item_contents, item_result = stack.pop()
+            if len(item_contents) > 0:
+                serialized_contents = item_result['contents'] = []
+                for inner_item in item_contents:
+                    inner_result = inner_item._serializable_node()
+                    serialized_contents.append(inner_result)
+                    inner_contents = inner_item.contents
+                    if len(inner_contents) > 0:
+                        stack.append((inner_contents, inner_result))
+        return result
+
+    def _serializable_node(self) -> dict:
+        """
+        Serialize this item only, without contents. Override this in subclasses, not serializable().
+        """
         result = {}
         if self.code is not None:
             result['code'] = self.code
 
         result['features'] = self.features
-
-        if len(self.contents) > 0:
-            result['contents'] = []
-            for item in self.contents:
-                # Yay for recursion!
-                result['contents'].append(item.serializable())
         return result
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Set
+
+from .Item import Item
+
+
+class ItemCache(object):
+    """
+    Read-through cache for Tarallo.get_item, with LRU eviction and a time to live.
+
+    Entries are keyed by code and depth limit. Items returned from the cache are shared between callers,
+    so don't modify them (clone them into an ItemToUpload if you need to).
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 60.0):
+        """
+        :param max_size: Maximum number of items to keep, the least recently used one is evicted when full
+        :param ttl: Seconds after which an entry expires, None to keep entries until they're evicted or invalidated
+        """
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # Incremented on every invalidation, to avoid caching a response fetched before a write
+        self.generation = 0
+        # (code, depth_limit) -> (expiry time, item, codes)
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __normalize(code: str) -> str:
+        # The server doesn't care about case ("schifomacchina" is "SCHIFOMACCHINA")
+        return code.upper()
+
+    @staticmethod
+    def __codes(item: Item) -> Set[str]:
+        """
+        Every code that makes this entry stale if it changes: the item, everything inside it and its location
+        """
+        codes = set()
+        for code in item.location:
+            codes.add(ItemCache.__normalize(code))
+        stack = [item]
+        while len(stack) > 0:
+            current = stack.pop()
+            codes.add(ItemCache.__normalize(current.code))
+            stack.extend(current.contents)
+        return codes
+
+    def get(self, code: str, depth_limit: Optional[int] = None) -> Optional[Item]:
+        """
+        Return the cached item, or None if it's not in the cache
+        """
+        key = (self.__normalize(code), depth_limit)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                del self.__entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, code: str, depth_limit: Optional[int], item: Item, generation: Optional[int] = None):
+        """
+        Add an item to the cache
+
+        :param generation: Value of self.generation before the item was requested to the server. If anything
+                           has been invalidated since then, the item may be stale and it's not cached.
+        """
+        expires = float('inf') if self.ttl is None else time.monotonic() + self.ttl
+        codes = self.__codes(item)
+        key = (self.__normalize(code), depth_limit)
+        with self.__lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.__entries[key] = (expires, item, codes)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *codes: Optional[str]):
+        """
+        Remove every entry that contains any of these items, at any depth, or that is located inside them.
+
+        E.g. after moving an item, invalidating the item and its new location removes the item itself,
+        the old and new location and everything above them, and everything inside the item.
+        """
+        stale = {self.__normalize(code) for code in codes if code is not None}
+        if len(stale) == 0:
+            return
+        with self.__lock:
+            self.generation += 1
+            for key in [key for key, entry in self.__entries.items() if not stale.isdisjoint(entry[2])]:
+                del self.__entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self.__lock:
+            self.generation += 1
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Counters, to tune max_size and ttl
+        """
+        with self.__lock:
+            return {
+                'size': len(self.__entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
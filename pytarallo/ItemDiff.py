@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Union, Tuple, Callable
+
+from .Item import Item
+from .ItemBase import ItemBase
+from .Tarallo import Tarallo, _submit
+
+Results = Dict[str, Union[bool, None, Exception]]
+
+
+class ItemDiff(object):
+    """
+    Changes between an item tree fetched from the server and an edited copy of it (e.g. an ItemToUpload
+    clone, or the same Item modified in place after a deep copy): the features that changed in each item,
+    the items that have been moved somewhere else in the tree, and the items that are not in the tree anymore.
+
+        pc = tarallo.get_item('PC42')
+        edited = ItemToUpload(pc)
+        edited.contents[0].features['working'] = 'no'
+        ItemDiff(pc, edited).apply(tarallo)
+
+    Only what changed is sent: one PATCH with the changed features for each item, one move for each item in a
+    different place and one lose for each item that is gone, instead of uploading the whole tree again.
+    New items (without a code) can't be added this way, use add_item.
+    """
+
+    def __init__(self, original: ItemBase, edited: ItemBase):
+        """
+        :raises ValueError: If the edited tree contains items without a code, or the same item twice
+        """
+        # Code -> features to PATCH, None to delete a feature
+        self.features: Dict[str, Dict[str, Any]] = {}
+        # Code -> new parent
+        self.moves: Dict[str, str] = {}
+        # Codes of the items to lose, only the outermost ones (the others go with them)
+        self.losses: List[str] = []
+        # Code -> depth in the edited tree, to move outer items first
+        self.__depths: Dict[str, int] = {}
+
+        before = self.__flatten(original)
+        after = self.__flatten(edited)
+        for key, (code, parent, features, depth) in after.items():
+            self.__depths[code] = depth
+            if key not in before:
+                # Moved here from outside the original tree, the features it had are unknown
+                if parent is not None:
+                    self.moves[code] = parent
+                continue
+            old_parent, old_features = before[key][1], before[key][2]
+            patch = {name: value for name, value in features.items()
+                     if name not in old_features or old_features[name] != value}
+            patch.update({name: None for name in old_features if name not in features})
+            if len(patch) > 0:
+                self.features[code] = patch
+            if parent is not None and (old_parent is None or parent.upper() != old_parent.upper()):
+                self.moves[code] = parent
+        for key, (code, parent, features, depth) in before.items():
+            if key not in after and (parent is None or parent.upper() in after):
+                self.losses.append(code)
+
+    def __len__(self):
+        return len(self.features) + len(self.moves) + len(self.losses)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    @staticmethod
+    def __flatten(root: ItemBase) -> Dict[str, Tuple[str, Optional[str], Dict[str, Any], int]]:
+        """
+        Code (upper case) -> (code, parent code, features, depth), without recursion
+        """
+        # The parent of the root is its location, for an Item, or parent, for an ItemToUpload
+        location = getattr(root, 'location', None)
+        parent = getattr(root, 'parent', None) or (location[-1] if location else None)
+        if isinstance(root, Item):
+            root.load_all()
+        items = {}
+        stack = [(root, parent, 0)]
+        while len(stack) > 0:
+            item, parent, depth = stack.pop()
+            if item.code is None:
+                raise ValueError("Items without a code can't be compared, use add_item to add them")
+            key = item.code.upper()
+            if key in items:
+                raise ValueError(f"{item.code} is in the tree twice")
+            items[key] = (item.code, parent, item.features, depth)
+            stack.extend((inner, item.code, depth + 1) for inner in item.contents)
+        return items
+
+    def apply(self, tarallo: Tarallo, max_workers: int = 8) -> Dict[str, Results]:
+        """
+        Send the changes to the server, concurrently: features first, then moves, then losses. Moves are sent
+        from the outermost items inwards, so that an item is never moved inside itself on the way (e.g. when
+        swapping two items).
+
+        :return: {'features': {code: result}, 'moves': {...}, 'losses': {...}}, where each result is what
+                 the Tarallo method returned, or the exception it raised
+        """
+        results = {'features': {}, 'moves': {}, 'losses': {}}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results['features'] = self.__run(executor, tarallo.update_item_features, self.features)
+            waves: Dict[int, Dict[str, str]] = {}
+            for code, parent in self.moves.items():
+                waves.setdefault(self.__depths[code], {})[code] = parent
+            for depth in sorted(waves):
+                results['moves'].update(self.__run(executor, tarallo.move, waves[depth]))
+            results['losses'] = self.__run(executor, tarallo.lose, {code: None for code in self.losses})
+        return results
+
+    @staticmethod
+    def __run(executor: ThreadPoolExecutor, method: Callable, arguments: Dict[str, Any]) -> Results:
+        def call(code: str, argument: Any):
+            try:
+                return method(code) if argument is None else method(code, argument)
+            except Exception as e:
+                return e
+
+        futures = {code: _submit(executor, call, code, argument) for code, argument in arguments.items()}
+        return {code: future.result() for code, future in futures.items()}
@@ -0,0 +1,205 @@
+from typing import Optional, Dict, Any, List, Set, Tuple
+
+from .Item import Item
+
+
+class ItemIndex(object):
+    """
+    Inverted index over an item tree, e.g. a location fetched with get_item: finds items by code, feature
+    or product without walking the tree every time.
+
+    Features of products count as features of their items, unless the item has the same feature.
+
+    The index is built walking the whole tree, which loads lazy items first (see Item.load_all). Add, move and
+    remove items through the index to keep it up to date: it changes the tree too (but not the server, use
+    Tarallo for that).
+
+        index = ItemIndex(tarallo.get_item('Polito'))
+        index.find('type', 'ram')
+        tarallo.move('R69', 'PC42')
+        index.move('R69', 'PC42')
+    """
+
+    def __init__(self, root: Item):
+        self.root = root
+        # Code (upper case) -> item
+        self.__items: Dict[str, Item] = {}
+        # Code (upper case) -> item that contains it, None for the root
+        self.__parents: Dict[str, Optional[Item]] = {}
+        # (name, value) -> codes
+        self.__features: Dict[Tuple[str, Any], Set[str]] = {}
+        # (brand, model, variant) -> codes
+        self.__products: Dict[Tuple[str, str, str], Set[str]] = {}
+        # (brand, model) -> variants
+        self.__variants: Dict[Tuple[str, str], Set[str]] = {}
+        # (name, value) -> (brand, model, variant) of the products with that feature
+        self.__product_features: Dict[Tuple[str, Any], Set[Tuple[str, str, str]]] = {}
+        self.__index(root, None)
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, code: str):
+        return code.upper() in self.__items
+
+    def get(self, code: str) -> Optional[Item]:
+        return self.__items.get(code.upper())
+
+    def parent(self, code: str) -> Optional[Item]:
+        """
+        Item that contains this one, None for the root
+
+        :raises KeyError: If the item is not in the index
+        """
+        return self.__parents[code.upper()]
+
+    def path(self, code: str) -> List[str]:
+        """
+        Location of an item, the same as Item.location of a top level item
+        """
+        path = []
+        parent = self.parent(code)
+        while parent is not None:
+            path.append(parent.code)
+            parent = self.__parents[parent.code.upper()]
+        path.extend(reversed(self.root.location or []))
+        path.reverse()
+        return path
+
+    def find(self, name: str, value: Any) -> List[Item]:
+        """
+        Items with this feature, either their own or from their product. Sorted by code.
+        """
+        codes = set(self.__features.get((name, value), ()))
+        for product in self.__product_features.get((name, value), ()):
+            codes.update(code for code in self.__products[product] if name not in self.__items[code].features)
+        return [self.__items[code] for code in sorted(codes)]
+
+    def by_product(self, brand: str, model: str, variant: Optional[str] = None) -> List[Item]:
+        """
+        Items of a product, or of any variant of it if variant is None. Sorted by code.
+        """
+        variants = self.__variants.get((brand, model), set()) if variant is None else (variant,)
+        codes = set()
+        for variant in variants:
+            codes.update(self.__products.get((brand, model, variant), ()))
+        return [self.__items[code] for code in sorted(codes)]
+
+    def add(self, item: Item, parent: str):
+        """
+        Add an item, and everything inside it, to another item in the index
+
+        :raises KeyError: If the parent is not in the index
+        :raises ValueError: If an item with the same code is already in the index
+        """
+        parent_item = self.__items[parent.upper()]
+        stack = [item]
+        while len(stack) > 0:
+            current = stack.pop()
+            if current.code.upper() in self.__items:
+                raise ValueError(f"{current.code} is already in the index")
+            stack.extend(current.contents)
+        # Only top level items have a location
+        item.location = None
+        parent_item.add_content(item)
+        self.__index(item, parent_item)
+
+    def move(self, code: str, parent: str):
+        """
+        Move an item, and everything inside it, to another item in the index
+
+        :raises KeyError: If the item or the parent are not in the index
+        :raises ValueError: If the item is the root, or the parent is inside the item
+        """
+        item = self.__items[code.upper()]
+        new_parent = self.__items[parent.upper()]
+        if item is self.root:
+            raise ValueError("Cannot move the root")
+        ancestor = new_parent
+        while ancestor is not None:
+            if ancestor is item:
+                raise ValueError(f"Cannot move {item.code} inside itself")
+            ancestor = self.__parents[ancestor.code.upper()]
+        old_parent = self.__parents[code.upper()]
+        old_parent.contents.remove(item)
+        new_parent.add_content(item)
+        self.__parents[code.upper()] = new_parent
+
+    def remove(self, code: str) -> Item:
+        """
+        Remove an item, and everything inside it
+
+        :raises KeyError: If the item is not in the index
+        :raises ValueError: If the item is the root
+        """
+        item = self.__items[code.upper()]
+        if item is self.root:
+            raise ValueError("Cannot remove the root")
+        self.__parents[code.upper()].contents.remove(item)
+        stack = [item]
+        while len(stack) > 0:
+            current = stack.pop()
+            self.__unindex(current)
+            stack.extend(current.contents)
+        return item
+
+    def update_features(self, code: str, features: Dict[str, Any]):
+        """
+        Same as Tarallo.update_item_features: None deletes a feature
+
+        :raises KeyError: If the item is not in the index
+        """
+        key = code.upper()
+        item = self.__items[key]
+        for name, value in features.items():
+            if name in item.features:
+                self.__discard(self.__features, (name, item.features[name]), key)
+            if value is None:
+                item.features.pop(name, None)
+            else:
+                item.features[name] = value
+                self.__features.setdefault((name, value), set()).add(key)
+
+    def __index(self, item: Item, parent: Optional[Item]):
+        item.load_all()
+        stack = [(item, parent)]
+        while len(stack) > 0:
+            current, current_parent = stack.pop()
+            key = current.code.upper()
+            self.__items[key] = current
+            self.__parents[key] = current_parent
+            for name, value in current.features.items():
+                self.__features.setdefault((name, value), set()).add(key)
+            product = current.product
+            if product is not None and product.brand is not None:
+                product_key = (product.brand, product.model, product.variant)
+                if product_key not in self.__products:
+                    for name, value in (product.features or {}).items():
+                        self.__product_features.setdefault((name, value), set()).add(product_key)
+                self.__products.setdefault(product_key, set()).add(key)
+                self.__variants.setdefault((product.brand, product.model), set()).add(product.variant)
+            stack.extend((inner, current) for inner in current.contents)
+
+    def __unindex(self, item: Item):
+        key = item.code.upper()
+        del self.__items[key]
+        del self.__parents[key]
+        for name, value in item.features.items():
+            self.__discard(self.__features, (name, value), key)
+        product = item.product
+        if product is not None and product.brand is not None:
+            product_key = (product.brand, product.model, product.variant)
+            self.__discard(self.__products, product_key, key)
+            if product_key not in self.__products:
+                # That was the last item of this product
+                self.__discard(self.__variants, (product.brand, product.model), product.variant)
+                for name, value in (product.features or {}).items():
+                    self.__discard(self.__product_features, (name, value), product_key)
+
+    @staticmethod
+    def __discard(index: Dict[Any, Set], key: Any, value: Any):
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if len(values) == 0:
+                del index[key]
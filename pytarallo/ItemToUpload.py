@@ -9,21 +9,39 @@ class ItemToUpload(ItemBase):
     """
     Item not existing on the server
     """
+    __slots__ = ('parent',)
     parent: Optional[str]
 
     def __init__(self, item: Optional[Item] = None):
         super().__init__()
+        self.parent = None
 
         if item:
             if not isinstance(item, Item):
                 raise TypeError("ItemToUpload takes an Item to clone, or None if you want to build a new item")
-            self.code = item.code
-            self.features = item.features
-            for inner_item_data in item.contents:
-                self.add_content(ItemToUpload(inner_item_data))
-            if len(item.location) > 0:
+            # Everything is needed anyway, better to fetch the lazy items a level at a time than one by one
+            item.load_all()
+            self.__clone(item)
+            if item.location:
                 self.parent = item.location[-1]
 
+            # Clone the contents with a stack, recursion would fail with very deep trees
+            stack = [(self, item)]
+            while len(stack) > 0:
+                clone, original = stack.pop()
+                clone_contents = clone.contents
+                for inner_item in original.contents:
+                    inner_clone = ItemToUpload()
+                    inner_clone.__clone(inner_item)
+                    clone_contents.append(inner_clone)
+                    if len(inner_item.contents) > 0:
+                        stack.append((inner_clone, inner_item))
+
+    def __clone(self, item: Item):
+        self.code = item.code
+        # Feature values are strings and numbers, a shallow copy is enough to change either of them on its own
+        self.features = dict(item.features)
+
     def add_content(self, item):
         if not isinstance(item, ItemToUpload):
             raise InvalidObjectError("ItemToUpload can only contain another ItemToUpload")
@@ -32,8 +50,8 @@ class ItemToUpload(ItemBase):
     def set_parent(self, parent: Optional[str]):
         self.parent = parent
 
-    def serializable(self) -> dict:
-        result = super().serializable()
+    def _serializable_node(self) -> dict:
+        result = super()._serializable_node()
         if self.parent is not None:
             result['parent'] = self.parent
         return result
@@ -0,0 +1,208 @@
+import threading
+from typing import Optional, Dict, Any, Iterable, List, Union
+
+
+class Histogram(object):
+    """
+    Cumulative histogram, same as the Prometheus ones
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(sorted(buckets))
+        # One more for +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[tuple]:
+        """
+        (upper bound, observations less than or equal to it), the last bound is +Inf
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'buckets': {_format_bound(bound): count for bound, count in self.cumulative()},
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class _OperationMetrics(object):
+    __slots__ = ('calls', 'errors', 'requests', 'shared', 'statuses', 'bytes_in', 'bytes_out', 'latency', 'network',
+                 'parse')
+
+    def __init__(self, buckets: Iterable[float]):
+        self.calls = 0
+        self.errors = 0
+        self.requests = 0
+        # Requests not sent, the response of an identical one was shared
+        self.shared = 0
+        # Status code (or "error" if there's no response) -> count
+        self.statuses: Dict[str, int] = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram(buckets)
+        self.network = Histogram(buckets)
+        self.parse = Histogram(buckets)
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms for each operation of Tarallo (get_item, move, bulk_add, ...).
+
+    For each operation, the time of the whole call is recorded in "latency". The time of each request,
+    retries included, is in "network". The time spent parsing JSON and building items from the responses
+    is in "parse". Requests made by an operation inside another one, e.g. the get_item and moves of a
+    travaso, are counted for the inner one. Requests sent with get, post, etc... directly are counted
+    as "get", "post", etc...
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        """
+        :param buckets: Upper bounds of the histogram buckets, in seconds
+        """
+        self.buckets = tuple(buckets)
+        self.__operations: Dict[str, _OperationMetrics] = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, operation: str) -> _OperationMetrics:
+        metrics = self.__operations.get(operation)
+        if metrics is None:
+            metrics = self.__operations[operation] = _OperationMetrics(self.buckets)
+        return metrics
+
+    def record_operation(self, operation: str, seconds: float, failed: bool = False):
+        """
+        A call to an operation has ended, successfully or raising an exception
+        """
+        with self.__lock:
+            metrics = self.__get(operation)
+            metrics.calls += 1
+            if failed:
+                metrics.errors += 1
+            metrics.latency.observe(seconds)
+
+    def record_request(self, operation: str, status: Optional[int], seconds: float, bytes_out: int = 0,
+                       bytes_in: int = 0):
+        """
+        A request has been sent
+
+        :param status: Status code of the response, None if there's no response (e.g. connection errors)
+        """
+        with self.__lock:
+            metrics = self.__get(operation)
+            metrics.requests += 1
+            status = 'error' if status is None else str(status)
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.bytes_out += bytes_out
+            metrics.bytes_in += bytes_in
+            metrics.network.observe(seconds)
+
+    def record_shared(self, operation: str):
+        """
+        A request has not been sent, because an identical one was in flight and its response has been shared
+        """
+        with self.__lock:
+            self.__get(operation).shared += 1
+
+    def record_parse(self, operation: str, seconds: float):
+        with self.__lock:
+            self.__get(operation).parse.observe(seconds)
+
+    def reset(self):
+        with self.__lock:
+            self.__operations.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Everything recorded so far, operation -> metrics
+        """
+        with self.__lock:
+            return {operation: {
+                'calls': metrics.calls,
+                'errors': metrics.errors,
+                'requests': metrics.requests,
+                'shared': metrics.shared,
+                'statuses': dict(metrics.statuses),
+                'bytes_in': metrics.bytes_in,
+                'bytes_out': metrics.bytes_out,
+                'latency': metrics.latency.snapshot(),
+                'network': metrics.network.snapshot(),
+                'parse': metrics.parse.snapshot(),
+            } for operation, metrics in self.__operations.items()}
+
+    def prometheus(self, prefix: str = 'pytarallo') -> str:
+        """
+        Everything recorded so far, in the Prometheus text format
+        """
+        lines = []
+
+        def counter(name: str, description: str, values: Dict[str, Union[int, Dict[str, int]]], label: str = None):
+            lines.append(f'# HELP {prefix}_{name} {description}')
+            lines.append(f'# TYPE {prefix}_{name} counter')
+            for operation, value in values.items():
+                labels = f'operation="{_escape(operation)}"'
+                if label is None:
+                    lines.append(f'{prefix}_{name}{{{labels}}} {value}')
+                else:
+                    for key, count in value.items():
+                        lines.append(f'{prefix}_{name}{{{labels},{label}="{_escape(key)}"}} {count}')
+
+        def histogram(name: str, description: str, values: Dict[str, Histogram]):
+            lines.append(f'# HELP {prefix}_{name} {description}')
+            lines.append(f'# TYPE {prefix}_{name} histogram')
+            for operation, value in values.items():
+                labels = f'operation="{_escape(operation)}"'
+                for bound, count in value.cumulative():
+                    lines.append(f'{prefix}_{name}_bucket{{{labels},le="{_format_bound(bound)}"}} {count}')
+                lines.append(f'{prefix}_{name}_sum{{{labels}}} {value.sum}')
+                lines.append(f'{prefix}_{name}_count{{{labels}}} {value.count}')
+
+        with self.__lock:
+            operations = self.__operations
+            counter('operations_total', 'Calls to each operation',
+                    {operation: metrics.calls for operation, metrics in operations.items()})
+            counter('operation_errors_total', 'Calls that raised an exception',
+                    {operation: metrics.errors for operation, metrics in operations.items()})
+            counter('requests_total', 'Requests sent to the server, by status code',
+                    {operation: metrics.statuses for operation, metrics in operations.items()}, 'status')
+            counter('shared_requests_total', 'Requests not sent, sharing the response of an identical one',
+                    {operation: metrics.shared for operation, metrics in operations.items()})
+            counter('received_bytes_total', 'Bytes in response bodies',
+                    {operation: metrics.bytes_in for operation, metrics in operations.items()})
+            counter('sent_bytes_total', 'Bytes in request bodies',
+                    {operation: metrics.bytes_out for operation, metrics in operations.items()})
+            histogram('operation_duration_seconds', 'Duration of each call to an operation',
+                      {operation: metrics.latency for operation, metrics in operations.items()})
+            histogram('request_duration_seconds', 'Duration of each request, without parsing',
+                      {operation: metrics.network for operation, metrics in operations.items()})
+            histogram('parse_duration_seconds', 'Time spent parsing responses and building objects',
+                      {operation: metrics.parse for operation, metrics in operations.items()})
+        return '\n'.join(lines) + '\n'
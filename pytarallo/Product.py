@@ -2,6 +2,8 @@ from typing import Optional, Dict, Any
 
 
 class Product:
+    # __weakref__ is needed by ProductRegistry
+    __slots__ = ('brand', 'model', 'variant', 'features', '__weakref__')
     brand: Optional[str]
     model: Optional[str]
     variant: Optional[str]
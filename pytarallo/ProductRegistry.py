@@ -0,0 +1,50 @@
+import threading
+import weakref
+from typing import Optional
+
+from .Product import Product
+
+
+class ProductRegistry(object):
+    """
+    Keeps a single Product instance for each brand, model and variant.
+
+    Items and products received from the server are resolved through the registry, so identical products
+    in a tree are the same object. Products are only kept as long as something else references them.
+    """
+
+    def __init__(self):
+        self.__products = weakref.WeakValueDictionary()
+        self.__lock = threading.Lock()
+
+    def resolve(self, data: dict) -> Product:
+        """
+        Return the Product for this data, creating it if needed.
+
+        If the product already exists with different features, a new Product replaces it in the registry:
+        data comes from the server and is the most recent, while items fetched earlier keep the product
+        they were fetched with.
+        """
+        key = (data.get('brand'), data.get('model'), data.get('variant'))
+        with self.__lock:
+            product = self.__products.get(key)
+            if product is None or product.features != data.get('features'):
+                product = Product(data)
+                self.__products[key] = product
+        return product
+
+    def get(self, brand: str, model: str, variant: str) -> Optional[Product]:
+        """
+        Return the Product if it's known, None otherwise
+        """
+        return self.__products.get((brand, model, variant))
+
+    def invalidate(self, brand: str, model: str, variant: str):
+        """
+        Forget a product, e.g. because it has been modified on the server
+        """
+        with self.__lock:
+            self.__products.pop((brand, model, variant), None)
+
+    def __len__(self):
+        return len(self.__products)
@@ -4,6 +4,8 @@ from .Product import Product
 
 
 class ProductToUpload(Product):
+    __slots__ = ()
+
     def __init__(self, data: dict):
         super().__init__(data)
 
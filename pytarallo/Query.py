@@ -0,0 +1,255 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Set, FrozenSet, Iterator, Tuple, Union
+
+from .Errors import ItemNotFoundError
+from .Item import Item
+from .Tarallo import Tarallo, _submit
+
+
+class Query(object):
+    """
+    Condition on items, combine them with & and |:
+
+        (Feature('type', 'ram') & Feature('capacity-byte', 1073741824)) | Feature('type', 'cpu')
+    """
+    __slots__ = ()
+
+    def __and__(self, other: 'Query') -> 'And':
+        return And(self, other)
+
+    def __or__(self, other: 'Query') -> 'Or':
+        return Or(self, other)
+
+    def leaves(self) -> Iterator['Query']:
+        """
+        Every Feature and Location in this query
+        """
+        stack = [self]
+        while len(stack) > 0:
+            query = stack.pop()
+            if isinstance(query, (And, Or)):
+                stack.extend(query.queries)
+            else:
+                yield query
+
+
+class Feature(Query):
+    """
+    Items that have a feature with this value
+    """
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name: str, value: Any):
+        self.name = name
+        self.value = value
+
+    def key(self) -> tuple:
+        return 'feature', self.name, str(self.value)
+
+    def __repr__(self):
+        return f'Feature({self.name!r}, {self.value!r})'
+
+
+class Location(Query):
+    """
+    Items inside a location (or any other item), at any depth
+    """
+    __slots__ = ('code',)
+
+    def __init__(self, code: str):
+        self.code = code
+
+    def key(self) -> tuple:
+        return 'location', self.code.upper()
+
+    def __repr__(self):
+        return f'Location({self.code!r})'
+
+
+class And(Query):
+    """
+    Items that match all the queries
+    """
+    __slots__ = ('queries',)
+
+    def __init__(self, *queries: Query):
+        if len(queries) == 0:
+            raise ValueError("And needs at least one query")
+        # And(And(a, b), c) is And(a, b, c)
+        self.queries: Tuple[Query, ...] = tuple(inner for query in queries
+                                                for inner in (query.queries if isinstance(query, And) else (query,)))
+
+    def __repr__(self):
+        return f"And({', '.join(repr(query) for query in self.queries)})"
+
+
+class Or(Query):
+    """
+    Items that match any of the queries
+    """
+    __slots__ = ('queries',)
+
+    def __init__(self, *queries: Query):
+        if len(queries) == 0:
+            raise ValueError("Or needs at least one query")
+        self.queries: Tuple[Query, ...] = tuple(inner for query in queries
+                                                for inner in (query.queries if isinstance(query, Or) else (query,)))
+
+    def __repr__(self):
+        return f"Or({', '.join(repr(query) for query in self.queries)})"
+
+
+class QueryRunner(object):
+    """
+    Finds the codes of the items that match a query.
+
+    Every Feature and Location in the query is a request to the server, and their results are cached for ttl
+    seconds, so running the same query (or a similar one) again is cheap. Features are a small request each,
+    they are all sent at once. Locations download everything inside them, so they are left for last: in a
+    conjunction, they aren't fetched at all if the other conditions match nothing, and with a few matches
+    left only the location of those items is checked.
+    Conjunctions are intersected starting from the smallest result, and stop as soon as it's empty.
+    """
+
+    def __init__(self, tarallo: Tarallo, ttl: Optional[float] = 60.0, max_workers: int = 8,
+                 max_candidates: int = 32):
+        """
+        :param tarallo: Session to send requests with
+        :param ttl: Seconds after which results are fetched again, None to keep them until clear()
+        :param max_workers: Maximum number of requests in flight at the same time
+        :param max_candidates: When this many items or fewer can still match, a Location fetches just them
+                               to check where they are, instead of everything inside the location
+        """
+        self.tarallo = tarallo
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.max_candidates = max_candidates
+        self.hits = 0
+        self.misses = 0
+        # key -> (expiry time, codes)
+        self.__results: Dict[tuple, Tuple[float, FrozenSet[str]]] = {}
+        self.__lock = threading.Lock()
+
+    def codes(self, query: Query) -> Set[str]:
+        """
+        Codes of the items that match the query
+        """
+        leaves = {leaf.key(): leaf for leaf in query.leaves()}
+        results = self.__cached(leaves)
+        results.update(self.__fetch([leaf for key, leaf in leaves.items()
+                                     if key not in results and isinstance(leaf, Feature)]))
+        return set(self.__evaluate(query, results, None))
+
+    def items(self, query: Query, depth_limit: Optional[int] = 0) -> List[Item]:
+        """
+        Items that match the query, sorted by code
+
+        :param depth_limit: Same as get_item, by default only the items themselves without their contents
+        """
+        items = []
+        for code, item in self.tarallo.get_items(sorted(self.codes(query)), depth_limit, self.max_workers):
+            # Deleted in the meantime
+            if not isinstance(item, ItemNotFoundError):
+                items.append(item)
+        return items
+
+    def clear(self):
+        with self.__lock:
+            self.__results.clear()
+
+    def __cached(self, leaves: Dict[tuple, Query]) -> Dict[tuple, FrozenSet[str]]:
+        now = time.monotonic()
+        results = {}
+        with self.__lock:
+            for key in leaves:
+                entry = self.__results.get(key)
+                if entry is not None and entry[0] >= now:
+                    results[key] = entry[1]
+            self.hits += len(results)
+        return results
+
+    def __fetch(self, leaves: List[Query]) -> Dict[tuple, FrozenSet[str]]:
+        if len(leaves) == 0:
+            return {}
+        with self.__lock:
+            self.misses += len(leaves)
+        expires = float('inf') if self.ttl is None else time.monotonic() + self.ttl
+        results = {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(leaves))) as executor:
+            futures = [_submit(executor, self.__lookup, leaf) for leaf in leaves]
+            for leaf, future in zip(leaves, futures):
+                results[leaf.key()] = future.result()
+        with self.__lock:
+            for key, codes in results.items():
+                self.__results[key] = (expires, codes)
+        return results
+
+    def __lookup(self, leaf: Union[Feature, Location]) -> FrozenSet[str]:
+        if isinstance(leaf, Feature):
+            return frozenset(self.tarallo.get_codes_by_feature(leaf.name, str(leaf.value)))
+        try:
+            location = self.tarallo.get_item(leaf.code)
+        except ItemNotFoundError:
+            return frozenset()
+        codes = set()
+        stack = list(location.contents)
+        while len(stack) > 0:
+            item = stack.pop()
+            codes.add(item.code)
+            stack.extend(item.contents)
+        return frozenset(codes)
+
+    def __filter(self, location: Location, candidates: FrozenSet[str]) -> FrozenSet[str]:
+        """
+        Candidates that are inside the location, from the location of each one of them
+        """
+        key = location.code.upper()
+        codes = set()
+        for code, item in self.tarallo.get_items(sorted(candidates), 0, self.max_workers):
+            if not isinstance(item, ItemNotFoundError) and any(part.upper() == key for part in item.location):
+                codes.add(code)
+        return frozenset(codes)
+
+    def __evaluate(self, query: Query, results: Dict[tuple, FrozenSet[str]],
+                   candidates: Optional[FrozenSet[str]]) -> FrozenSet[str]:
+        """
+        :param results: Leaves fetched so far, by key, more are added when needed
+        :param candidates: Only these codes can match, None for any code
+        """
+        if isinstance(query, And):
+            codes = candidates
+            for inner in sorted(query.queries, key=lambda inner: self.__cost(inner, results)):
+                codes = self.__evaluate(inner, results, codes)
+                if len(codes) == 0:
+                    break
+            return codes
+        if isinstance(query, Or):
+            if candidates is None or len(candidates) > self.max_candidates:
+                # Every location in here will be downloaded anyway, all at once
+                locations = {inner.key(): inner for inner in query.queries
+                             if isinstance(inner, Location) and inner.key() not in results}
+                results.update(self.__fetch(list(locations.values())))
+            codes = set()
+            for inner in query.queries:
+                codes |= self.__evaluate(inner, results, candidates)
+            return frozenset(codes)
+        key = query.key()
+        if key not in results:
+            if candidates is not None and len(candidates) <= self.max_candidates:
+                return self.__filter(query, candidates)
+            results.update(self.__fetch([query]))
+        return results[key] if candidates is None else results[key] & candidates
+
+    @staticmethod
+    def __cost(query: Query, results: Dict[tuple, FrozenSet[str]]) -> Tuple[int, int]:
+        """
+        Order of the queries in a conjunction: fetched leaves first, smallest first (intersecting a small set
+        with a large one is cheap), then conjunctions and disjunctions, then locations still to download
+        """
+        if isinstance(query, (And, Or)):
+            return 1, 0
+        if query.key() in results:
+            return 0, len(results[query.key()])
+        return 2, 0
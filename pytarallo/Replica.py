@@ -0,0 +1,299 @@
+import json
+import sqlite3
+from typing import Optional, Dict, Any, List, Set, Tuple, Iterable
+
+from .Errors import ItemNotFoundError
+from .Item import Item
+from .ProductRegistry import ProductRegistry
+from .Tarallo import Tarallo
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    code TEXT PRIMARY KEY COLLATE NOCASE,
+    parent TEXT COLLATE NOCASE,
+    path TEXT NOT NULL,
+    -- Among the contents of the parent
+    position INTEGER NOT NULL,
+    brand TEXT,
+    model TEXT,
+    variant TEXT
+);
+CREATE INDEX IF NOT EXISTS items_parent ON items (parent);
+CREATE INDEX IF NOT EXISTS items_product ON items (brand, model, variant);
+CREATE TABLE IF NOT EXISTS features (
+    code TEXT NOT NULL COLLATE NOCASE,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (code, name)
+);
+CREATE INDEX IF NOT EXISTS features_value ON features (name, value);
+CREATE TABLE IF NOT EXISTS product_features (
+    brand TEXT NOT NULL,
+    model TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (brand, model, variant, name)
+);
+CREATE INDEX IF NOT EXISTS product_features_value ON product_features (name, value);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+# Codes of an item and everything inside it, with their depth
+_SUBTREE = '''
+WITH RECURSIVE subtree (code, depth) AS (
+    SELECT code, 0 FROM items WHERE code = :code
+    UNION ALL
+    SELECT items.code, subtree.depth + 1 FROM items JOIN subtree ON items.parent = subtree.code
+    WHERE :depth IS NULL OR subtree.depth < :depth
+)
+'''
+
+
+class Replica(object):
+    """
+    Local copy of the inventory in a SQLite database, to answer location, feature and product lookups
+    without touching the server.
+
+    snapshot() copies some locations and everything inside them, sync() keeps the copy up to date: it
+    fetches the same locations again, one request each, and writes only the items that changed, were added
+    (created or moved there from somewhere else) or are gone. Only the writes are incremental: TARALLO has no
+    feed of the changes to the whole inventory, and asking for the history of each item is slower than fetching
+    them all again, so a sync downloads as much as a snapshot.
+    """
+
+    def __init__(self, tarallo: Tarallo, path: str = ':memory:', max_workers: int = 8):
+        """
+        :param tarallo: Session to fetch items with
+        :param path: SQLite database file, created if it doesn't exist
+        :param max_workers: Maximum number of requests in flight at the same time
+        """
+        self.tarallo = tarallo
+        self.max_workers = max_workers
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def __get_state(self, key: str) -> Any:
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def __set_state(self, key: str, value: Any):
+        self.db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    @property
+    def roots(self) -> List[str]:
+        """
+        Locations copied by the last snapshot
+        """
+        return self.__get_state('roots') or []
+
+    # Synchronization
+
+    def snapshot(self, *roots: str) -> int:
+        """
+        Replace everything with a fresh copy of these items and everything inside them
+
+        :param roots: Codes, by default the same as last time
+        :return: Number of items in the replica
+        """
+        if len(roots) == 0:
+            roots = tuple(self.roots)
+        if len(roots) == 0:
+            raise ValueError("No items to copy")
+        items = []
+        for code, item in self.tarallo.get_items(roots, max_workers=self.max_workers):
+            if isinstance(item, ItemNotFoundError):
+                raise item
+            items.append(item)
+        rows, features, products = self.__flatten(items)
+        with self.db:
+            self.db.execute('DELETE FROM items')
+            self.db.execute('DELETE FROM features')
+            self.__write(rows.values(), features.values(), products)
+            self.__set_state('roots', list(roots))
+        return len(self)
+
+    def sync(self) -> Set[str]:
+        """
+        Fetch the copied locations again, and update the items that changed since the last snapshot or sync.
+        Items created in the copied locations or moved there are added, items that have been deleted, lost or
+        moved somewhere else are removed. If a copied location doesn't exist anymore, everything in it is removed.
+
+        :return: Codes of the items that have been updated, added or removed. Moving an item changes the
+                 location of everything inside it, so they count as updated too.
+        """
+        roots = self.roots
+        if len(roots) == 0:
+            raise ValueError("Take a snapshot first")
+        items = [item for code, item in self.tarallo.get_items(roots, max_workers=self.max_workers)
+                 if not isinstance(item, ItemNotFoundError)]
+        rows, features, products = self.__flatten(items)
+
+        old_rows = {row[0].upper(): row for row in self.db.execute(
+            'SELECT code, parent, path, position, brand, model, variant FROM items')}
+        old_features: Dict[str, Dict[str, Any]] = {}
+        for code, name, value in self.db.execute('SELECT code, name, value FROM features'):
+            old_features.setdefault(code.upper(), {})[name] = value
+
+        removed = [row[0] for key, row in old_rows.items() if key not in rows]
+        changed_rows = [row for key, row in rows.items() if old_rows.get(key) != row]
+        changed_features = [(key, item_features) for key, item_features in features.items()
+                            if old_features.get(key, {}) != dict((name, value) for _, name, value in item_features)]
+        with self.db:
+            self.db.executemany('DELETE FROM items WHERE code = ?', [(code,) for code in removed])
+            self.db.executemany('DELETE FROM features WHERE code = ?',
+                                [(code,) for code in removed] + [(key,) for key, _ in changed_features])
+            self.__write(changed_rows, (item_features for _, item_features in changed_features), products)
+        # Items that only changed position, because something next to them has been added or removed, don't count
+        moved = {row[0] for row in changed_rows if self.__without_position(old_rows.get(row[0].upper()))
+                 != self.__without_position(row)}
+        return set(removed) | moved | {rows[key][0] for key, _ in changed_features}
+
+    @staticmethod
+    def __without_position(row: Optional[tuple]) -> Optional[tuple]:
+        return None if row is None else row[:3] + row[4:]
+
+    @staticmethod
+    def __flatten(items: List[Item]) -> Tuple[Dict[str, tuple], Dict[str, List[tuple]], Dict[tuple, Dict[str, Any]]]:
+        """
+        Rows for the tables, of these items and everything inside them, without recursion
+
+        :return: Code (upper case) -> row of items, code (upper case) -> rows of features, and
+                 (brand, model, variant) -> features of the products
+        """
+        rows = {}
+        features = {}
+        products = {}
+        for item in items:
+            location = item.location or []
+            stack = [(item, location[-1] if len(location) > 0 else None, location, 0)]
+            while len(stack) > 0:
+                current, parent, path, position = stack.pop()
+                product = current.product
+                if product is not None and product.brand is not None:
+                    key = (product.brand, product.model, product.variant)
+                    products[key] = product.features or {}
+                else:
+                    key = (None, None, None)
+                code = current.code.upper()
+                rows[code] = (current.code, parent, json.dumps(path), position) + key
+                features[code] = [(current.code, name, value) for name, value in current.features.items()]
+                inner_path = path + [current.code]
+                stack.extend((inner, current.code, inner_path, inner_position)
+                             for inner_position, inner in enumerate(current.contents))
+        return rows, features, products
+
+    def __write(self, rows: Iterable[tuple], features: Iterable[List[tuple]], products: Dict[tuple, Dict[str, Any]]):
+        """
+        Add or replace items, features and all the product features
+        """
+        self.db.executemany('INSERT OR REPLACE INTO items (code, parent, path, position, brand, model, variant) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.executemany('INSERT OR REPLACE INTO features (code, name, value) VALUES (?, ?, ?)',
+                            (row for item_features in features for row in item_features))
+        self.db.execute('DELETE FROM product_features')
+        self.db.executemany('INSERT INTO product_features (brand, model, variant, name, value) VALUES (?, ?, ?, ?, ?)',
+                            [(brand, model, variant, name, value)
+                             for (brand, model, variant), product_features in products.items()
+                             for name, value in product_features.items()])
+
+    # Queries
+
+    def get_item(self, code: str, depth_limit: Optional[int] = None) -> Item:
+        """
+        Same as Tarallo.get_item, from the replica
+        """
+        parameters = {'code': code, 'depth': depth_limit}
+        rows = self.db.execute(_SUBTREE + 'SELECT items.code, items.parent, items.path, brand, model, variant '
+                                          'FROM subtree JOIN items ON items.code = subtree.code '
+                                          'ORDER BY subtree.depth, items.position', parameters).fetchall()
+        if len(rows) == 0:
+            raise ItemNotFoundError(f"Item {code} doesn't exist")
+        data: Dict[str, Dict[str, Any]] = {}
+        products: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        for item_code, parent, path, brand, model, variant in rows:
+            item_data = {'code': item_code, 'features': {}}
+            if brand is not None:
+                key = (brand, model, variant)
+                if key not in products:
+                    products[key] = {'brand': brand, 'model': model, 'variant': variant, 'features': {}}
+                item_data['product'] = products[key]
+            data[item_code.upper()] = item_data
+            if len(data) > 1:
+                data[parent.upper()].setdefault('contents', []).append(item_data)
+        root = data[rows[0][0].upper()]
+        root['location'] = json.loads(rows[0][2])
+
+        for item_code, name, value in self.db.execute(
+                _SUBTREE + 'SELECT features.code, name, value FROM subtree '
+                           'JOIN features ON features.code = subtree.code', parameters):
+            data[item_code.upper()]['features'][name] = value
+        for (brand, model, variant), product in products.items():
+            product['features'] = dict(self.db.execute(
+                'SELECT name, value FROM product_features WHERE brand = ? AND model = ? AND variant = ?',
+                (brand, model, variant)))
+        return Item(root, products=ProductRegistry())
+
+    def location(self, code: str) -> List[str]:
+        """
+        Location of an item, the same as Item.location
+        """
+        row = self.db.execute('SELECT path FROM items WHERE code = ?', (code,)).fetchone()
+        if row is None:
+            raise ItemNotFoundError(f"Item {code} doesn't exist")
+        return json.loads(row[0])
+
+    def contents(self, code: str, recursive: bool = False) -> List[str]:
+        """
+        Codes of the items inside an item
+
+        :param recursive: Everything inside, at any depth, instead of the items directly inside
+        """
+        rows = self.db.execute(_SUBTREE + 'SELECT items.code FROM subtree JOIN items ON items.code = subtree.code '
+                                          'WHERE depth > 0 ORDER BY depth, position',
+                               {'code': code, 'depth': None if recursive else 1})
+        return [row[0] for row in rows]
+
+    def codes_by_feature(self, name: str, value: Any) -> List[str]:
+        """
+        Codes of the items with this feature, either their own or from their product (which they can override)
+
+        :param value: Same type as in the features (e.g. 1073741824, not "1073741824")
+        """
+        rows = self.db.execute(
+            'SELECT code FROM features WHERE name = :name AND value = :value '
+            'UNION '
+            'SELECT items.code FROM product_features JOIN items '
+            'ON items.brand = product_features.brand AND items.model = product_features.model '
+            'AND items.variant = product_features.variant '
+            'WHERE product_features.name = :name AND product_features.value = :value '
+            'AND NOT EXISTS (SELECT 1 FROM features WHERE features.code = items.code AND features.name = :name) '
+            'ORDER BY code', {'name': name, 'value': value})
+        return [row[0] for row in rows]
+
+    def codes_by_product(self, brand: str, model: str, variant: Optional[str] = None) -> List[str]:
+        """
+        Codes of the items of a product, or of any variant of it if variant is None
+        """
+        if variant is None:
+            rows = self.db.execute('SELECT code FROM items WHERE brand = ? AND model = ? ORDER BY code',
+                                   (brand, model))
+        else:
+            rows = self.db.execute('SELECT code FROM items WHERE brand = ? AND model = ? AND variant = ? '
+                                   'ORDER BY code', (brand, model, variant))
+        return [row[0] for row in rows]
@@ -0,0 +1,117 @@
+import random
+import threading
+import time
+from typing import Optional, Iterable
+
+from .Errors import CircuitOpenError
+
+
+class RetryPolicy(object):
+    """
+    Which requests to retry, and how long to wait between attempts.
+
+    Only idempotent requests are retried, when the server answers with a 5xx or the connection drops.
+    The wait grows exponentially with each attempt, with full jitter so that many clients retrying at
+    the same time don't hit the server all together.
+    """
+
+    def __init__(self, max_retries: int = 3, backoff: float = 0.1, max_backoff: float = 10.0,
+                 statuses: Iterable[int] = (500, 502, 503, 504), methods: Iterable[str] = ('GET', 'PUT', 'DELETE')):
+        """
+        :param max_retries: Maximum number of retries after the first attempt
+        :param backoff: Base wait in seconds, the maximum wait is backoff * 2^attempt
+        :param max_backoff: Never wait longer than this, in seconds
+        :param statuses: Status codes to retry
+        :param methods: HTTP methods to retry. POST and PATCH aren't idempotent, don't add them.
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(method.upper() for method in methods)
+
+    def can_retry(self, method: str, attempt: int) -> bool:
+        """
+        :param method: HTTP method
+        :param attempt: Number of attempts already made, starting from 1
+        """
+        return attempt <= self.max_retries and method.upper() in self.methods
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Seconds to wait before the next attempt
+
+        :param attempt: Number of attempts already made, starting from 1
+        :param retry_after: Retry-After header of the last response, if any
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast while the server is down, instead of piling more requests (and retries) on it.
+
+    After failure_threshold consecutive failures the circuit opens, and every request fails immediately
+    with CircuitOpenError. After reset_timeout seconds a single trial request is let through: if it
+    succeeds the circuit closes again, otherwise it stays open for another reset_timeout.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        :param failure_threshold: Consecutive failures (5xx or connection errors) that open the circuit
+        :param reset_timeout: Seconds to wait before trying again when the circuit is open
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.__state = self.CLOSED
+        self.__opened_at = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self.__lock:
+            if self.__state == self.OPEN and time.monotonic() - self.__opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self.__state
+
+    def before_request(self):
+        """
+        Raise CircuitOpenError if the request shouldn't be sent
+        """
+        with self.__lock:
+            if self.__state == self.CLOSED:
+                return
+            if self.__state == self.OPEN and time.monotonic() - self.__opened_at >= self.reset_timeout:
+                # Let this one through, everything else fails until we know how it went
+                self.__state = self.HALF_OPEN
+                return
+            raise CircuitOpenError("Too many failures, not sending requests to the server for a while")
+
+    def release(self):
+        """
+        A request let through by before_request ended without a success or a failure to record (e.g. an
+        exception in a hook): if it was the trial request, let the next one be the trial instead
+        """
+        with self.__lock:
+            if self.__state == self.HALF_OPEN:
+                # Still open, but reset_timeout is over
+                self.__state = self.OPEN
+
+    def record_success(self):
+        with self.__lock:
+            self.failures = 0
+            self.__state = self.CLOSED
+
+    def record_failure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.__state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.__state = self.OPEN
+                self.__opened_at = time.monotonic()
@@ -1,98 +1,408 @@
+import codecs
+import contextvars
+import functools
 import json
+import threading
+import time
 import urllib.parse
-from typing import Optional
+import zlib
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from typing import Optional, Iterable, Iterator, Tuple, Union, Dict, Any, Callable, List
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ReadTimeout, Timeout
 
 from .AuditEntry import AuditEntry, AuditChanges
+from .Codec import JsonCodec, get_codec
 from .Errors import *
-from .Item import Item
+from .Hooks import Hooks, Span
+from .Item import Item, ItemLoader
+from .ItemCache import ItemCache
 from .ItemToUpload import ItemToUpload
-from .Product import Product
+from .Metrics import Metrics
+from .ProductRegistry import ProductRegistry
 from .ProductToUpload import ProductToUpload
+from .Retry import RetryPolicy, CircuitBreaker
+from .ValidationCache import ValidationCache
+
+
+# Absolute time.monotonic() by which the current operation must be done, if any
+_deadline = contextvars.ContextVar('pytarallo_deadline', default=None)
+# Name of the innermost operation running, for metrics
+_operation_name = contextvars.ContextVar('pytarallo_operation', default=None)
+# Span of the innermost operation running, if there are any hooks
+_span = contextvars.ContextVar('pytarallo_span', default=None)
+
+
+def _end_span(hooks: List[Hooks], span: Span, error: Optional[Exception] = None):
+    span.finish(error)
+    for hook in hooks:
+        if error is not None:
+            hook.on_error(span, error)
+        hook.end_span(span)
+
+
+def _submit(executor: ThreadPoolExecutor, func, *args, deadline: Optional[float] = None) -> Future:
+    """
+    Run func in a thread of the executor, with the same context as this one: deadline, span, operation name...
+
+    :param deadline: Replaces the deadline of the context, if not None
+    """
+    context = contextvars.copy_context()
+    if deadline is not None:
+        context.run(_deadline.set, deadline)
+    return executor.submit(context.run, func, *args)
+
+
+class _Flight(object):
+    """
+    A GET in flight, shared with everyone asking for the same URL until it's done
+    """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Tuple[requests.Response, Any]] = None
+        self.error: Optional[Exception] = None
+
+
+def _operation(func):
+    """
+    Public methods of Tarallo, which may be made of many requests: the deadline starts from the outermost one,
+    metrics are recorded and a span is started for each one
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def inner(self, *args, **kwargs):
+        name_token = _operation_name.set(name)
+        deadline_token = None
+        if self.deadline is not None and _deadline.get() is None:
+            deadline_token = _deadline.set(time.monotonic() + self.deadline)
+        span = span_token = None
+        if len(self.hooks) > 0:
+            span = Span(name, _span.get())
+            for hook in self.hooks:
+                hook.start_span(span)
+            span_token = _span.set(span)
+        start = time.perf_counter()
+        error = None
+        try:
+            return func(self, *args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.record_operation(name, time.perf_counter() - start, error is not None)
+            if span is not None:
+                _span.reset(span_token)
+                _end_span(self.hooks, span, error)
+            if deadline_token is not None:
+                _deadline.reset(deadline_token)
+            _operation_name.reset(name_token)
+    return inner
 
 
 class Tarallo(object):
-    """This class handles the Tarallo session"""
-
-    def __init__(self, url: str, token: str):
+    """
+    This class handles the Tarallo session
+
+    A single instance can be shared between threads: every method works on its own response, and all of them
+    reuse the connections of the same requests.Session.
+    """
+
+    def __init__(self, url: str, token: str, cache: Optional[ItemCache] = None, retry: Optional[RetryPolicy] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None, pool_size: int = 32,
+                 max_connections: Optional[int] = None, connect_timeout: Optional[float] = None,
+                 read_timeout: Optional[float] = None, deadline: Optional[float] = None,
+                 codec: Union[str, JsonCodec, None] = None, validation_cache: Optional[ValidationCache] = None,
+                 metrics: Optional[Metrics] = None, hooks: Iterable[Hooks] = (), single_flight: bool = False):
         """
         :param url: Tarallo URL
         :param token: Token (go to Options > Get token)
+        :param cache: Optional cache for get_item, invalidated by the methods that modify items
+        :param retry: Optional policy to retry idempotent requests on 5xx errors and dropped connections
+        :param circuit_breaker: Optional circuit breaker, to fail fast while the server is down
+        :param pool_size: Connections to keep alive, per host. Make it at least as large as the number of threads
+                          sharing this session (e.g. max_workers of get_items), or connections will be discarded
+                          and opened again.
+        :param max_connections: Hard limit on connections per host, requests beyond it wait for a free one.
+                                Replaces pool_size if set.
+        :param connect_timeout: Seconds to wait for a connection, None to wait forever
+        :param read_timeout: Seconds to wait for the server to answer, None to wait forever.
+                             Raises RequestTimeoutError if exceeded.
+        :param deadline: Seconds each method has to complete, including all its requests (e.g. travaso) and retries.
+                         Raises DeadlineExceededError if exceeded.
+        :param codec: JSON codec, or its name ("json" or "orjson"). By default orjson if installed, json otherwise.
+        :param validation_cache: Optional cache of ETags and Last-Modified, to skip downloading and parsing
+                                 responses that haven't changed since the last time
+        :param metrics: Optional, to record counters and latency histograms of each operation
+        :param hooks: Called when operations and requests start and end, more can be appended to self.hooks later
+        :param single_flight: Threads asking for the same item (or product, history...) at the same time share
+                              a single request and the object built from its response, instead of sending
+                              one request each. Like with the cache, the item they get is the same object.
         """
         self.url = url.rstrip('/')
         self.token = token.strip()
+        self.products = ProductRegistry()
+        self.cache = cache
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.codec = get_codec(codec)
+        self.validation_cache = validation_cache
+        self.metrics = metrics
+        self.hooks: List[Hooks] = list(hooks)
+        self.single_flight = single_flight
+        # URL -> GET in flight
+        self.__flights: Dict[str, _Flight] = {}
+        self.__flights_lock = threading.Lock()
         self.__session = requests.Session()
-        self.response = None
+        adapter = HTTPAdapter(pool_maxsize=max_connections or pool_size, pool_block=max_connections is not None)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+        self.__local = threading.local()
+
+    @property
+    def response(self) -> Optional[requests.Response]:
+        """
+        Last response received in the current thread.
+
+        Kept for compatibility only, use the response returned by get, post, etc... instead
+        """
+        return getattr(self.__local, 'response', None)
+
+    def __invalidate(self, *codes: Optional[str]):
+        if self.cache is not None:
+            self.cache.invalidate(*codes)
 
     def __prepare_url(self, url: str) -> str:
         return self.url + '/' + url.lstrip('/')
 
-    def __check_response(self):
-        if self.response.status_code == 401:
+    @staticmethod
+    def __check_response(response: requests.Response):
+        if response.status_code == 401:
             raise AuthenticationError
-        if self.response.status_code >= 500:
+        if response.status_code >= 500:
             raise ServerError
 
-    # requests.Session() wrapper methods
-    # These guys implement further checks
     @raises_no_internet_connection_error
-    def get(self, url: str) -> requests.Response:
-        url = self.__prepare_url(url)
-        headers = {"Authorization": "Token " + self.token}
-        # cookies={"XDEBUG_SESSION": "PHPSTORM"}
-        self.response = self.__session.get(url, headers=headers)
-        self.__check_response()
-        return self.response
-
-    @raises_no_internet_connection_error
-    def delete(self, url: str) -> requests.Response:
-        url = self.__prepare_url(url)
-        headers = {"Authorization": "Token " + self.token}
-        self.response = self.__session.delete(url, headers=headers)
-        self.__check_response()
-        return self.response
-
-    @raises_no_internet_connection_error
-    def post(self, url: str, data, headers=None) -> requests.Response:
+    def __request(self, method: str, url: str, data=None, headers=None, stream: bool = False) -> requests.Response:
         if headers is None:
             headers = {}
-        if "Content-Type" not in headers:
+        if data is not None and "Content-Type" not in headers:
             headers["Content-Type"] = "application/json"
         headers["Authorization"] = "Token " + self.token
         url = self.__prepare_url(url)
-        self.response = self.__session.post(url, data=data, headers=headers)
-        self.__check_response()
-        return self.response
+        # Generators and files can't be sent twice
+        replayable = data is None or isinstance(data, (str, bytes))
+        deadline = _deadline.get()
+        if deadline is None and self.deadline is not None:
+            # get, post, etc... called directly
+            deadline = time.monotonic() + self.deadline
+        operation = _operation_name.get() or method.lower()
+        # Bytes sent in the body, counted while sending if it's streamed
+        sent = [len(data.encode('utf-8') if isinstance(data, str) else data) if replayable and data else 0]
+        if self.metrics is not None and not replayable:
+            data = self.__counting(data, sent)
+        attempt = 0
+        while True:
+            attempt += 1
+            connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceededError(f"Deadline exceeded before {method} {url}")
+                connect_timeout = remaining if connect_timeout is None else min(connect_timeout, remaining)
+                read_timeout = remaining if read_timeout is None else min(read_timeout, remaining)
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_request()
+            # Whether the circuit breaker has been told how this attempt went
+            recorded = self.circuit_breaker is None
+            try:
+                span = None
+                if len(self.hooks) > 0:
+                    span = Span(f'{method} {urllib.parse.urlsplit(url).path}', _span.get(),
+                                {'http.method': method, 'http.url': url, 'attempt': attempt})
+                    for hook in self.hooks:
+                        hook.start_span(span)
+                    for hook in self.hooks:
+                        hook.before_request(span, method, url, headers)
+                start = time.perf_counter()
+                try:
+                    # cookies={"XDEBUG_SESSION": "PHPSTORM"}
+                    response = self.__session.request(method, url, data=data, headers=headers,
+                                                      timeout=(connect_timeout, read_timeout), stream=stream)
+                except (ConnectionError, Timeout) as e:
+                    if self.metrics is not None:
+                        self.metrics.record_request(operation, None, time.perf_counter() - start, sent[0])
+                    if span is not None:
+                        _end_span(self.hooks, span, e)
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record_failure()
+                        recorded = True
+                    if replayable and self.retry is not None and self.retry.can_retry(method, attempt) \
+                            and self.__sleep(self.retry.delay(attempt), deadline):
+                        continue
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise DeadlineExceededError(f"Deadline exceeded during {method} {url}") from e
+                    if isinstance(e, ReadTimeout):
+                        raise RequestTimeoutError(f"Timeout during {method} {url}") from e
+                    # ConnectionError, becomes a NoInternetConnectionError
+                    raise
+                if self.metrics is not None:
+                    self.metrics.record_request(operation, response.status_code, time.perf_counter() - start, sent[0],
+                                                int(response.headers.get('Content-Length', 0)) if stream
+                                                else len(response.content))
+                if span is not None:
+                    span.attributes['http.status_code'] = response.status_code
+                    for hook in self.hooks:
+                        hook.after_response(span, response)
+                    _end_span(self.hooks, span)
+                if response.status_code >= 500:
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record_failure()
+                        recorded = True
+                    if replayable and self.retry is not None and response.status_code in self.retry.statuses \
+                            and self.retry.can_retry(method, attempt) \
+                            and self.__sleep(self.retry.delay(attempt, response.headers.get('Retry-After')), deadline):
+                        response.close()
+                        continue
+                elif self.circuit_breaker is not None:
+                    self.circuit_breaker.record_success()
+                    recorded = True
+                break
+            finally:
+                if not recorded:
+                    # Neither a response nor a connection error (e.g. a hook raised): if this was the trial
+                    # request of an open circuit, let another one through
+                    self.circuit_breaker.release()
+        if method != 'GET' and len(self.__flights) > 0:
+            # Whoever asks from now on may see the change, they can't join requests sent before it
+            with self.__flights_lock:
+                self.__flights.clear()
+        self.__local.response = response
+        self.__check_response(response)
+        return response
+
+    @staticmethod
+    def __counting(data: Iterable[bytes], sent: list) -> Iterator[bytes]:
+        # Size of a body that is sent in chunks, as it's sent
+        for chunk in data:
+            sent[0] += len(chunk)
+            yield chunk
+
+    @staticmethod
+    def __sleep(seconds: float, deadline: Optional[float]) -> bool:
+        """
+        Wait before retrying, unless that would go past the deadline
+
+        :return: True if there's time to retry, False otherwise
+        """
+        if deadline is not None and time.monotonic() + seconds >= deadline:
+            return False
+        time.sleep(seconds)
+        return True
+
+    # requests.Session() wrapper methods
+    # These guys implement further checks
+    def get(self, url: str, headers=None) -> requests.Response:
+        return self.__request('GET', url, headers=headers)
+
+    def delete(self, url: str) -> requests.Response:
+        return self.__request('DELETE', url)
+
+    def post(self, url: str, data, headers=None) -> requests.Response:
+        return self.__request('POST', url, data, headers)
 
-    @raises_no_internet_connection_error
     def put(self, url: str, data, headers=None) -> requests.Response:
-        if headers is None:
-            headers = {}
-        if "Content-Type" not in headers:
-            headers["Content-Type"] = "application/json"
-        headers["Authorization"] = "Token " + self.token
-        url = self.__prepare_url(url)
-        self.response = self.__session.put(url, data=data, headers=headers)
-        self.__check_response()
-        return self.response
+        return self.__request('PUT', url, data, headers)
 
-    @raises_no_internet_connection_error
     def patch(self, url: str, data, headers=None) -> requests.Response:
-        if headers is None:
-            headers = {}
-        if "Content-Type" not in headers:
-            headers["Content-Type"] = "application/json"
-        headers["Authorization"] = "Token " + self.token
-        url = self.__prepare_url(url)
-        self.response = self.__session.patch(url, data=data, headers=headers)
-        self.__check_response()
-        return self.response
+        return self.__request('PATCH', url, data, headers)
+
+    def __get_parsed(self, url: str, parse: Callable[[bytes], Any],
+                     shared: bool = True) -> Tuple[requests.Response, Any]:
+        """
+        GET url and parse the body, or reuse what was parsed last time if it hasn't changed (with a validation cache)
+
+        :param parse: Called with the body of the response, if the status is 200
+        :param shared: The parsed body can be shared: use the validation cache, if there's one, and join an
+                       identical request in flight (with single_flight)
+        :return: The response and the parsed body, which is None unless the status is 200 or 304
+        """
+        if not shared or not self.single_flight:
+            return self.__fetch_parsed(url, parse, shared)
+        with self.__flights_lock:
+            flight = self.__flights.get(url)
+            joined = flight is not None
+            if not joined:
+                flight = self.__flights[url] = _Flight()
+        if joined:
+            return self.__join(url, parse, flight)
+        try:
+            flight.result = self.__fetch_parsed(url, parse, shared)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.__flights_lock:
+                # Unless a write removed it already
+                if self.__flights.get(url) is flight:
+                    del self.__flights[url]
+            flight.done.set()
+
+    def __join(self, url: str, parse: Callable[[bytes], Any], flight: _Flight) -> Tuple[requests.Response, Any]:
+        """
+        Wait for a GET sent by another thread, and share its result
+        """
+        operation = _operation_name.get() or 'get'
+        deadline = _deadline.get()
+        if deadline is None and self.deadline is not None:
+            deadline = time.monotonic() + self.deadline
+        if not flight.done.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+            raise DeadlineExceededError(f"Deadline exceeded waiting for GET {self.__prepare_url(url)}")
+        if self.metrics is not None:
+            self.metrics.record_shared(operation)
+        if flight.result is None:
+            if flight.error is None or isinstance(flight.error, DeadlineExceededError):
+                # The other thread has been interrupted (e.g. KeyboardInterrupt) or ran out of time, this one
+                # may still have some
+                return self.__fetch_parsed(url, parse, True)
+            raise flight.error
+        self.__local.response = flight.result[0]
+        return flight.result
+
+    def __fetch_parsed(self, url: str, parse: Callable[[bytes], Any],
+                       revalidate: bool) -> Tuple[requests.Response, Any]:
+        cache = self.validation_cache if revalidate else None
+        response = self.get(url, None if cache is None else cache.headers(url))
+        if response.status_code == 304 and cache is not None:
+            found, parsed = cache.not_modified(url)
+            if found:
+                return response, parsed
+            # Evicted in the meantime
+            response = self.get(url)
+        if response.status_code == 200:
+            start = time.perf_counter()
+            parsed = parse(response.content)
+            if self.metrics is not None:
+                self.metrics.record_parse(_operation_name.get() or 'get', time.perf_counter() - start)
+            if cache is not None:
+                cache.put(url, response, parsed)
+            return response, parsed
+        return response, None
 
     @staticmethod
     def urlencode(part: str):
         return urllib.parse.quote(part, safe='')
 
+    @_operation
     def status(self):
         """
         Returns the status_code of /v2/session, useful for testing purposes.
@@ -100,22 +410,79 @@ class Tarallo(object):
         try:
             return self.get('/v2/session').status_code
         except AuthenticationError:
-            return self.response.status_code
+            return 401
 
-    def get_item(self, code: str, depth_limit: Optional[int] = None):
+    @_operation
+    def get_item(self, code: str, depth_limit: Optional[int] = None, lazy: bool = False,
+                 prefetch_siblings: bool = False):
         """
-        Return an Item instance received from the server
+        Return an Item instance received from the server (or from the cache, if there's one)
+
+        :param code: Item code
+        :param depth_limit: How many levels of contents to fetch, None for everything
+        :param lazy: With a depth_limit, the contents of the items at the limit are fetched from the server
+                     the first time they are accessed, instead of being empty. Lazy items are never cached.
+        :param prefetch_siblings: With lazy, when a lazy item is expanded, also fetch the items next to it
         """
+        lazy = lazy and depth_limit is not None
+        generation = None
+        if self.cache is not None and not lazy:
+            item = self.cache.get(code, depth_limit)
+            if item is not None:
+                return item
+            generation = self.cache.generation
         url = f'/v2/items/{self.urlencode(code)}?separate'  # try an Item without product
         if depth_limit is not None:
             url += '&depth=' + str(int(depth_limit))
-        self.get(url)
-        if self.response.status_code == 200:
-            item = Item(json.loads(self.response.content))
+        # Lazy items change as they're loaded, they can't be shared
+        response, item = self.__get_parsed(
+            url, lambda content: Item(self.codec.loads(content), products=self.products), not lazy)
+        if item is not None:
+            if lazy:
+                ItemLoader.make_lazy(item, self, depth_limit, prefetch_siblings)
+            elif self.cache is not None:
+                self.cache.put(code, depth_limit, item, generation)
             return item
-        elif self.response.status_code == 404:
+        elif response.status_code == 404:
             raise ItemNotFoundError(f"Item {code} doesn't exist")
 
+    def get_items(self, codes: Iterable[str], depth_limit: Optional[int] = None, max_workers: int = 8,
+                  ordered: bool = True, lazy: bool = False,
+                  prefetch_siblings: bool = False) -> Iterator[Tuple[str, Union[Item, ItemNotFoundError]]]:
+        """
+        Fetch many items concurrently, from a pool of threads that share this session (and its connections)
+
+        :param codes: Codes of the items to fetch
+        :param depth_limit: Same as get_item
+        :param lazy: Same as get_item
+        :param prefetch_siblings: Same as get_item
+        :param max_workers: Maximum number of requests in flight at the same time
+        :param ordered: Yield results in the same order as codes if True, as soon as they arrive if False
+        :return: Generator of (code, result) tuples, where result is the Item or, if it doesn't exist,
+                 an ItemNotFoundError. Any other exception is raised as usual.
+        """
+        deadline = _deadline.get()
+        if deadline is None and self.deadline is not None:
+            deadline = time.monotonic() + self.deadline
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {_submit(executor, self.__get_item_or_error, code, depth_limit, lazy, prefetch_siblings,
+                               deadline=deadline): code for code in codes}
+            try:
+                for future in (futures if ordered else as_completed(futures)):
+                    yield futures[future], future.result()
+            finally:
+                # Stop whatever hasn't started yet, e.g. if the caller breaks out of the loop
+                for future in futures:
+                    future.cancel()
+
+    def __get_item_or_error(self, code: str, depth_limit: Optional[int], lazy: bool,
+                            prefetch_siblings: bool) -> Union[Item, ItemNotFoundError]:
+        try:
+            return self.get_item(code, depth_limit, lazy, prefetch_siblings)
+        except ItemNotFoundError as e:
+            return e
+
+    @_operation
     def get_product_list(self, brand: str, model: str):
         """returns an list of Product retrieved from the server
         Args:
@@ -124,50 +491,58 @@ class Tarallo(object):
             list of Products
         """
         url = f'/v2/products/{self.urlencode(brand)}/{self.urlencode(model)}'
-        self.get(url)
-        if self.response.status_code == 200:
-            res = json.loads(self.response.content)
-            product_list = []
-            for p in res:
-                product_list.append(Product(p))
-            return product_list
-        elif self.response.status_code == 404:
+        response, product_list = self.__get_parsed(
+            url, lambda content: [self.products.resolve(p) for p in self.codec.loads(content)])
+        if product_list is not None:
+            return list(product_list)
+        elif response.status_code == 404:
             raise ProductNotFoundError("Product doesn't exists.")
 
+    @_operation
     def get_product(self, brand: str, model: str, variant: str = "default"):
         """Retrieve a product from the server
-        Returns a Product
+        Returns a Product, the same instance as before if it hasn't changed
 
         :param variant:
         :param brand:
         :param model:
         """
         url = f'/v2/products/{self.urlencode(brand)}/{self.urlencode(model)}/{self.urlencode(variant)}'
-        self.get(url)
-        if self.response.status_code == 200:
-            res = json.loads(self.response.content)
-            p = Product(res)
+        response, p = self.__get_parsed(url, lambda content: self.products.resolve(self.codec.loads(content)))
+        if p is not None:
             return p
-        elif self.response.status_code == 404:
+        elif response.status_code == 404:
             raise ProductNotFoundError("Product doesn't exists.")
 
+    @_operation
     def add_item(self, item: ItemToUpload):
         """Add an item to the database and eventually update its code
             """
         if item.code is not None:  # check whether an item's code was manually added
-            self.put(f'/v2/items/{self.urlencode(item.code)}', data=json.dumps(item.serializable()))
-            added_item_status = self.response.status_code
+            response = self.put(f'/v2/items/{self.urlencode(item.code)}', data=self.codec.dumps(item.serializable()))
         else:
-            self.post('/v2/items', data=json.dumps(item.serializable()))
-            added_item_status = self.response.status_code
+            response = self.post('/v2/items', data=self.codec.dumps(item.serializable()))
+        added_item_status = response.status_code
+        self.__invalidate(item.code, getattr(item, 'parent', None), *self.__inner_codes(item))
         if added_item_status == 201:
-            item.code = json.loads(self.response.content)
+            item.code = self.codec.loads(response.content)
             return True
         elif added_item_status == 400 or added_item_status == 404:
             raise ValidationError
         elif added_item_status == 403:
             raise NotAuthorizedError
 
+    @staticmethod
+    def __inner_codes(item: ItemToUpload):
+        # Items with a code inside an ItemToUpload may already exist somewhere else, and be moved by add_item
+        stack = list(item.contents)
+        while len(stack) > 0:
+            inner_item = stack.pop()
+            if inner_item.code is not None:
+                yield inner_item.code
+            stack.extend(inner_item.contents)
+
+    @_operation
     def add_product(self, product: ProductToUpload):
         """adds a product to the database
         Args:
@@ -176,9 +551,9 @@ class Tarallo(object):
             True if success, Errors exceptions otherwise
         """
         bmv = f"{self.urlencode(product.brand)}/{self.urlencode(product.model)}/{self.urlencode(product.variant)}"
-        self.put(f'/v2/products/{bmv}',
-                 data=json.dumps(product.serializable()))
-        added_product_status = self.response.status_code
+        added_product_status = self.put(f'/v2/products/{bmv}',
+                                        data=self.codec.dumps(product.serializable())).status_code
+        self.products.invalidate(product.brand, product.model, product.variant)
         if added_product_status == 201:
             return True
         elif added_product_status == 400 or added_product_status == 404:
@@ -186,34 +561,42 @@ class Tarallo(object):
         elif added_product_status == 403:
             raise NotAuthorizedError
 
+    @_operation
     def update_item_features(self, code: str, features: dict):
         """
         Send updated features to the database (this is the PATCH endpoint)
         """
-        self.patch(f'/v2/items/{self.urlencode(code)}/features', json.dumps(features))
-        if self.response.status_code == 200 or self.response.status_code == 204:
+        update_status = self.patch(f'/v2/items/{self.urlencode(code)}/features', self.codec.dumps(features)).status_code
+        self.__invalidate(code)
+        if update_status == 200 or update_status == 204:
             return True
-        elif self.response.status_code == 400:
+        elif update_status == 400:
             raise ValidationError("Impossible to update feature/s")
-        elif self.response.status_code == 404:
+        elif update_status == 404:
             raise ItemNotFoundError(f"Item {code} doesn't exist")
 
+    @_operation
     def update_product_features(self, brand: str, model: str, variant: str, features: dict):
         bmv = f"{self.urlencode(brand)}/{self.urlencode(model)}/{self.urlencode(variant)}"
         url = f"/v2/products/{bmv}/features"
-        self.patch(url, json.dumps(features))
-        if self.response.status_code == 200 or self.response.status_code == 204:
+        update_status = self.patch(url, self.codec.dumps(features)).status_code
+        self.products.invalidate(brand, model, variant)
+        if update_status == 200 or update_status == 204:
             return True
-        elif self.response.status_code == 400:
+        elif update_status == 400:
             raise ValidationError("Impossible to update feature/s")
-        elif self.response.status_code == 404:
+        elif update_status == 404:
             raise ProductNotFoundError(f"Product doesn't exist")
 
+    @_operation
     def move(self, code: str, location: str):
         """
         Move an item to another location
         """
-        move_status = self.put(f'v2/items/{self.urlencode(code)}/parent', json.dumps(location)).status_code
+        response = self.put(f'v2/items/{self.urlencode(code)}/parent', self.codec.dumps(location))
+        move_status = response.status_code
+        # Removes the item, everything that contained it (old location) and everything that contains the new one
+        self.__invalidate(code, location)
         if move_status == 204 or move_status == 201 or move_status == 200:
             # 200 is the one that's currently used, the response contains some potentially
             # useful info which is just discarded because we don't need it anywhere rigth now
@@ -221,7 +604,7 @@ class Tarallo(object):
         elif move_status == 400:
             raise ValidationError(f"Cannot move {code} into {location}")
         elif move_status == 404:
-            response_json = json.loads(self.response.content)
+            response_json = self.codec.loads(response.content)
             if 'item' not in response_json:
                 raise ServerError("Server didn't find an item, but isn't telling us which one")
             if response_json['item'] == location:
@@ -231,21 +614,24 @@ class Tarallo(object):
         else:
             raise RuntimeError(f"Move failed with {move_status}")
 
+    @_operation
     def lose(self, code: str):
         """
         Move an item to another location
         """
-        lose_status = self.delete(f'v2/items/{self.urlencode(code)}/parent').status_code
+        response = self.delete(f'v2/items/{self.urlencode(code)}/parent')
+        lose_status = response.status_code
+        self.__invalidate(code)
         if lose_status == 204:
             return True
         elif lose_status == 400:
-            response_json = json.loads(self.response.content)
+            response_json = self.codec.loads(response.content)
             if "message" in response_json:
                 raise ValidationError(f"Cannot lose {code}: {response_json['message']}")
             else:
                 raise ValidationError(f"Cannot lose {code}")
         elif lose_status == 404:
-            response_json = json.loads(self.response.content)
+            response_json = self.codec.loads(response.content)
             if 'item' in response_json:
                 raise ItemNotFoundError(f"Item {response_json['item']} doesn't exist")
             else:
@@ -253,12 +639,14 @@ class Tarallo(object):
         else:
             raise RuntimeError(f"Move failed with {lose_status}")
 
+    @_operation
     def delete_product(self, brand: str, model: str, variant: str):
         """
         send a DELETE request to the server to remove a product
         """
         bmv = f"{self.urlencode(brand)}/{self.urlencode(model)}/{self.urlencode(variant)}"
         delete_status = self.delete(f"v2/products/{bmv}").status_code
+        self.products.invalidate(brand, model, variant)
         if delete_status == 200 or delete_status == 204:
             # Actually deleted
             return True
@@ -267,6 +655,7 @@ class Tarallo(object):
         else:
             return False
 
+    @_operation
     def remove_item(self, code: str):
         """
         Remove an item from the database
@@ -275,6 +664,7 @@ class Tarallo(object):
                  False if deletion failed
         """
         item_status = self.delete(f'/v2/items/{self.urlencode(code)}').status_code
+        self.__invalidate(code)
         deleted_status = self.get(f'/v2/deleted/{self.urlencode(code)}').status_code
         if deleted_status == 200:
             # Actually deleted
@@ -285,6 +675,7 @@ class Tarallo(object):
         else:
             return False
 
+    @_operation
     def restore_item(self, code: str, location: str):
         """
         Restores a deleted item
@@ -292,12 +683,14 @@ class Tarallo(object):
         :return: True if item successfully restored
                  False if failed to restore
         """
-        item_status = self.put(f'/v2/deleted/{self.urlencode(code)}/parent', json.dumps(location)).status_code
+        item_status = self.put(f'/v2/deleted/{self.urlencode(code)}/parent', self.codec.dumps(location)).status_code
+        self.__invalidate(code, location)
         if item_status == 201:
             return True
         else:
             return False
 
+    @_operation
     def bulk_add(self, upload, identifier: Optional[str] = None, overwrite: bool = False):
         """
         Perform a bulk add, to import items from peracotta
@@ -307,55 +700,195 @@ class Tarallo(object):
         :param overwrite: Overwrite if there's a computer with the same identifier
         :return:
         """
-        url = '/v2/bulk/add'
-        if identifier:
-            url += '/' + self.urlencode(identifier)
-        if overwrite:
-            url += '?overwrite=true'
-        result = self.post(url, json.dumps(upload)).status_code
+        result = self.post(self.__bulk_url(identifier, overwrite), self.codec.dumps(upload)).status_code
         # 409 if is a duplicate
         if result == 204:
             return True
         else:
             return False
 
+    @_operation
+    def bulk_add_stream(self, upload, identifier: Optional[str] = None, overwrite: bool = False,
+                        compress: bool = False) -> Optional[bool]:
+        """
+        Same as bulk_add, but the upload is serialized and sent a piece at a time instead of all at once
+
+        :param upload: Iterable (e.g. a generator) of the elements of the upload, or a file that contains the json
+        :param identifier: Optional text to identify the computer
+        :param overwrite: Overwrite if there's a computer with the same identifier
+        :param compress: Gzip the request, the server must accept Content-Encoding: gzip
+        :return: True if added, None if there's already a computer with the same identifier, False otherwise
+        """
+        headers = {'Content-Encoding': 'gzip'} if compress else None
+        result = self.post(self.__bulk_url(identifier, overwrite), self.__stream(upload, compress), headers)
+        if result.status_code == 204:
+            return True
+        elif result.status_code == 409:
+            return None
+        else:
+            return False
+
+    @_operation
+    def bulk_add_many(self, uploads: Iterable[Tuple[str, Any]], overwrite: bool = False, compress: bool = False,
+                      max_workers: int = 4) -> Dict[str, Union[bool, None, Exception]]:
+        """
+        Import many computers at once, one bulk add each, concurrently
+
+        :param uploads: (identifier, upload) tuples, where each upload is the same as in bulk_add_stream
+        :param overwrite: Overwrite computers with the same identifier
+        :param compress: Same as bulk_add_stream
+        :param max_workers: Maximum number of uploads at the same time
+        :return: identifier -> what bulk_add_stream returned, or the exception it raised
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {_submit(executor, self.bulk_add_stream, upload, identifier, overwrite, compress): identifier
+                       for identifier, upload in uploads}
+            results = {}
+            for future, identifier in futures.items():
+                try:
+                    results[identifier] = future.result()
+                except Exception as e:
+                    results[identifier] = e
+            return results
+
+    def __bulk_url(self, identifier: Optional[str], overwrite: bool) -> str:
+        url = '/v2/bulk/add'
+        if identifier:
+            url += '/' + self.urlencode(identifier)
+        if overwrite:
+            url += '?overwrite=true'
+        return url
+
+    def __stream(self, upload, compress: bool, chunk_size: int = 65536) -> Iterator[bytes]:
+        """
+        Serialize an upload in chunks of about chunk_size bytes, to be sent with chunked transfer encoding
+        """
+        if hasattr(upload, 'read'):
+            def pieces():
+                while True:
+                    piece = upload.read(chunk_size)
+                    if not piece:
+                        return
+                    yield piece.encode('utf-8') if isinstance(piece, str) else piece
+        else:
+            def pieces():
+                yield b'['
+                separator = b''
+                for element in upload:
+                    yield separator + self.codec.dumps(element)
+                    separator = b','
+                yield b']'
+
+        compressor = zlib.compressobj(wbits=31) if compress else None  # 31 is the gzip format
+        buffer = bytearray()
+        for piece in pieces():
+            buffer += compressor.compress(piece) if compressor else piece
+            if len(buffer) >= chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+        if compressor:
+            buffer += compressor.flush()
+        yield bytes(buffer)
+
+    @_operation
     def travaso(self, code, location):
         item = self.get_item(code, 1)
         codes = []
         for inner_item in item.contents:
             codes.append(inner_item.code)
+        # Every move invalidates the cache
         for inner_code in codes:
             self.move(inner_code, location)
         return True
 
+    @_operation
     def get_history(self, code: str, limit: Optional[int] = None):
         url = f'/v2/items/{self.urlencode(code)}/history'
         if limit is not None:
             url += '?length=' + str(int(limit))
-        history = self.get(url)
+        history, result = self.__get_parsed(url, self.__parse_history)
 
-        if history.status_code == 200:
-            result = []
-            for entry in history.json():
-                try:
-                    change = AuditChanges(entry["change"])
-                except ValueError:
-                    change = AuditChanges.Unknown
-                result.append(AuditEntry(entry["user"], change, float(entry["time"]), entry["other"]))
-            return result
+        if result is not None:
+            return list(result)
         elif history.status_code == 404:
             raise ItemNotFoundError(f"Item {code} doesn\'t exist")
         else:
             raise RuntimeError("Unexpected return code")
 
+    def __parse_history(self, content: bytes):
+        return [self.__audit_entry(entry) for entry in self.codec.loads(content)]
+
+    @staticmethod
+    def __audit_entry(entry: dict) -> AuditEntry:
+        try:
+            change = AuditChanges(entry["change"])
+        except ValueError:
+            change = AuditChanges.Unknown
+        return AuditEntry(entry["user"], change, float(entry["time"]), entry["other"])
+
+    def iter_history(self, code: str, limit: Optional[int] = None, chunk_size: int = 8192) -> Iterator[AuditEntry]:
+        """
+        Same as get_history, but entries are parsed while the response is downloaded and yielded one at a time,
+        newest first. Stop iterating whenever you've found what you need (e.g. the last move), the rest is not
+        downloaded. Memory use doesn't depend on the length of the history.
+
+        :param limit: Maximum number of entries, None for the server default
+        :param chunk_size: Bytes to read at a time
+        """
+        url = f'/v2/items/{self.urlencode(code)}/history'
+        if limit is not None:
+            url += '?length=' + str(int(limit))
+        # This is a generator, setting the operation name here would leak it to the caller
+        context = contextvars.copy_context()
+        context.run(_operation_name.set, 'iter_history')
+        history = context.run(self.__request, 'GET', url, stream=True)
+        try:
+            if history.status_code == 404:
+                raise ItemNotFoundError(f"Item {code} doesn\'t exist")
+            elif history.status_code != 200:
+                raise RuntimeError("Unexpected return code")
+            for entry in self.__iter_json_array(history.iter_content(chunk_size)):
+                yield self.__audit_entry(entry)
+        finally:
+            # Discards the connection if the response hasn't been read completely
+            history.close()
+
+    @staticmethod
+    def __iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+        """
+        Parse a JSON array of objects a piece at a time, yield each element as soon as it's complete
+        """
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder('utf-8')()
+        buffer = ''
+        for chunk in chunks:
+            buffer += text.decode(chunk)
+            position = 0
+            while True:
+                # Skip the opening bracket, commas and whitespace
+                while position < len(buffer) and buffer[position] in '[, \t\r\n':
+                    position += 1
+                if position < len(buffer) and buffer[position] == ']':
+                    return
+                try:
+                    element, position = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    # Incomplete, wait for the next chunk
+                    break
+                yield element
+            buffer = buffer[position:]
+        # The closing bracket never arrived
+        raise ValueError("Incomplete JSON array")
+
+    @_operation
     def get_codes_by_feature(self, feature: str, value: str):
         url = f"/v2/features/{self.urlencode(feature)}/{self.urlencode(value)}"
-        items = self.get(url)
+        items, codes = self.__get_parsed(url, self.codec.loads)
 
-        if items.status_code == 200:
-            return items.json()
+        if codes is not None:
+            return list(codes)
         elif items.status_code == 400:
-            exception = items.json()
+            exception = self.codec.loads(items.content)
             raise ValidationError(exception.get('message', 'No message from the server'))
         else:
             raise RuntimeError("Unexpected return code")
@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+import requests
+
+
+class ValidationCache(object):
+    """
+    HTTP validation cache for the GET requests of Tarallo: get_item, get_product(_list), get_history and
+    get_codes_by_feature.
+
+    The ETag and Last-Modified of each response are stored with the object parsed from it, and sent back
+    with the next request to the same URL. If the server answers 304 Not Modified, the parsed object is
+    returned again without downloading or parsing anything. Unlike ItemCache, every call still makes a
+    request, so results are never stale. Responses without validators are not cached.
+
+    Items returned from the cache are shared between callers, so don't modify them.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        """
+        :param max_size: Maximum number of URLs to keep, the least recently used one is evicted when full
+        """
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Body of the 200 responses that didn't need to be downloaded again
+        self.bytes_saved = 0
+        # url -> (etag, last modified, parsed object, body length)
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def headers(self, url: str) -> Optional[Dict[str, str]]:
+        """
+        Conditional headers for a request to url, None if there's nothing cached
+        """
+        with self.__lock:
+            entry = self.__entries.get(url)
+        if entry is None:
+            return None
+        headers = {}
+        if entry[0] is not None:
+            headers['If-None-Match'] = entry[0]
+        if entry[1] is not None:
+            headers['If-Modified-Since'] = entry[1]
+        return headers
+
+    def not_modified(self, url: str) -> Tuple[bool, Any]:
+        """
+        The server answered 304 to a request to url
+
+        :return: True and the cached object, or False and None if it's not in the cache anymore
+        """
+        with self.__lock:
+            entry = self.__entries.get(url)
+            if entry is None:
+                return False, None
+            self.__entries.move_to_end(url)
+            self.hits += 1
+            self.bytes_saved += entry[3]
+            return True, entry[2]
+
+    def put(self, url: str, response: requests.Response, parsed: Any):
+        """
+        Store the object parsed from a 200 response, if it has any validators
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        with self.__lock:
+            self.misses += 1
+            if etag is None and last_modified is None:
+                self.__entries.pop(url, None)
+                return
+            self.__entries[url] = (etag, last_modified, parsed, len(response.content))
+            self.__entries.move_to_end(url)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Counters, to measure how much is saved
+        """
+        with self.__lock:
+            return {
+                'size': len(self.__entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes_saved': self.bytes_saved,
+            }
@@ -11,9 +11,11 @@ setup(
     author_email='weeeopen@polito.it',
     description='Python API for the T.A.R.A.L.L.O. Inventory System',
     keywords=['WEEEOpen', 'python-tarallo', 'T.A.R.A.L.L.O.', 'Inventory system'],
-    install_requires=['requests'],
+    install_requires=['requests', 'contextvars; python_version < "3.7"'],
     extras_require={
-        'dev': ['nose', 'python-dotenv']
+        'dev': ['nose', 'python-dotenv', 'httpx', 'orjson'],
+        'async': ['httpx'],
+        'fast': ['orjson'],
     },
     classifiers=[
         'Development Status :: 4 - Beta',
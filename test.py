@@ -1,4 +1,6 @@
+import asyncio
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from collections import Iterable
 from os import environ as env
@@ -7,10 +9,12 @@ from dotenv import load_dotenv
 
 from pytarallo.AuditEntry import AuditEntry
 from pytarallo.Item import Item
+from pytarallo.ItemCache import ItemCache
 from pytarallo.ItemToUpload import ItemToUpload
 from pytarallo.Product import Product
 from pytarallo.ProductToUpload import ProductToUpload
 from pytarallo.Tarallo import Tarallo
+from pytarallo.AsyncTarallo import AsyncTarallo
 from pytarallo.Errors import ItemNotFoundError, LocationNotFoundError, ValidationError
 
 load_dotenv()
@@ -22,6 +26,15 @@ except KeyError:
     raise EnvironmentError("Missing definitions of TARALLO_* environment variables (see README)")
 
 
+def run_async(coroutine):
+    # asyncio.run only exists since Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
 def test_invalid_login():
     tarallo_session = Tarallo(t_url, 'invalid')
     assert tarallo_session.status() == 401
@@ -541,3 +554,92 @@ def test_bulk_add():
     assert not tarallo_session.bulk_add(json.loads(upload), identifier)
     # Upload succeeds with overwrite
     assert tarallo_session.bulk_add(json.loads(upload), identifier, True)
+
+
+def test_get_items():
+    tarallo_session = Tarallo(t_url, t_token)
+    codes = ['schifomacchina', 'R69', 'asd', 'R188']
+    results = list(tarallo_session.get_items(codes, max_workers=4))
+    assert [code for code, _ in results] == codes
+    assert results[0][1].code == 'SCHIFOMACCHINA'
+    assert results[1][1].code == 'R69'
+    assert isinstance(results[2][1], ItemNotFoundError)
+    assert results[3][1].code == 'R188'
+
+
+def test_get_items_unordered():
+    tarallo_session = Tarallo(t_url, t_token)
+    results = dict(tarallo_session.get_items(['schifomacchina', 'R69'], depth_limit=0, ordered=False))
+    assert set(results) == {'schifomacchina', 'R69'}
+    assert len(results['schifomacchina'].contents) == 0
+
+
+def test_shared_session_threads():
+    tarallo_session = Tarallo(t_url, t_token)
+    # One thread keeps getting 404s, the other one 200s: none of them should see the status of the other
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        found = [executor.submit(tarallo_session.get_item, 'R69') for _ in range(20)]
+        missing = [executor.submit(tarallo_session.get_item, 'asd') for _ in range(20)]
+        for future in found:
+            assert future.result().code == 'R69'
+        for future in missing:
+            assert isinstance(future.exception(), ItemNotFoundError)
+
+
+def test_cache():
+    tarallo_session = Tarallo(t_url, t_token, cache=ItemCache(max_size=10, ttl=60))
+    item = tarallo_session.get_item('schifomacchina')
+    assert tarallo_session.get_item('SCHIFOMACCHINA') is item
+    assert tarallo_session.cache.hits == 1
+    assert tarallo_session.cache.misses == 1
+
+    # Moving something out of it invalidates it
+    tarallo_session.move("R69", "RamBox")
+    item_moved = tarallo_session.get_item('schifomacchina')
+    assert item_moved is not item
+    assert tarallo_session.cache.misses == 2
+    tarallo_session.move("R69", "schifomacchina")
+    assert tarallo_session.get_item('schifomacchina') is not item_moved
+
+
+def test_shared_products():
+    tarallo_session = Tarallo(t_url, t_token)
+    # Same product, same instance
+    case1 = tarallo_session.get_item('schifomacchina')
+    case2 = tarallo_session.get_item('schifomacchina')
+    assert isinstance(case1.product, Product)
+    assert case1.product is case2.product
+    p = case1.product
+    assert tarallo_session.get_product(p.brand, p.model, p.variant) is p
+
+
+def test_async_get_item():
+    async def run():
+        async with AsyncTarallo(t_url, t_token) as tarallo_session:
+            return await asyncio.gather(tarallo_session.get_item('schifomacchina'), tarallo_session.get_item('R69'))
+
+    item, item_r69 = run_async(run())
+    assert type(item) == Item
+    assert item.code == 'SCHIFOMACCHINA'
+    assert item.location == ["Polito", "Chernobyl", "Table"]
+    assert item_r69.code == 'R69'
+
+
+@raises(ItemNotFoundError)
+def test_async_get_invalid_item():
+    async def run():
+        async with AsyncTarallo(t_url, t_token) as tarallo_session:
+            await tarallo_session.get_item('asd')
+
+    run_async(run())
+
+
+def test_async_get_history():
+    async def run():
+        async with AsyncTarallo(t_url, t_token) as tarallo_session:
+            return await tarallo_session.get_history('schifomacchina')
+
+    history = run_async(run())
+    assert len(history) > 0
+    for entry in history:
+        assert isinstance(entry, AuditEntry)
@@ -0,0 +1,1060 @@
+import asyncio
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from nose.tools import *
+
+from pytarallo.AsyncTarallo import AsyncTarallo
+from pytarallo.AuditEntry import AuditChanges
+from pytarallo.Codec import JsonCodec, OrjsonCodec, get_codec
+from pytarallo.FakeServer import FakeServer
+from pytarallo.FeatureBuffer import FeatureBuffer
+from pytarallo.Hooks import Hooks, SpanRecorder
+from pytarallo.Item import Item
+from pytarallo.ItemCache import ItemCache
+from pytarallo.ItemDiff import ItemDiff
+from pytarallo.ItemIndex import ItemIndex
+from pytarallo.ItemToUpload import ItemToUpload
+from pytarallo.Metrics import Metrics
+from pytarallo.Query import Feature, Location, And, Or, QueryRunner
+from pytarallo.Replica import Replica
+from pytarallo.Retry import RetryPolicy, CircuitBreaker
+from pytarallo.Tarallo import Tarallo
+from pytarallo.ValidationCache import ValidationCache
+from pytarallo.Errors import ItemNotFoundError, LocationNotFoundError, ValidationError, ServerError, \
+    NoInternetConnectionError, CircuitOpenError, RequestTimeoutError, DeadlineExceededError
+
+# Same as test.py, but against a FakeServer: no TARALLO instance or network needed
+
+
+def run_async(coroutine):
+    # asyncio.run only exists since Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_invalid_login():
+    with FakeServer() as server:
+        assert Tarallo(server.url, 'invalid').status() == 401
+
+
+def test_login():
+    with FakeServer() as server:
+        assert Tarallo(server.url, server.token).status() == 200
+
+
+@raises(ItemNotFoundError)
+def test_get_invalid_item():
+    with FakeServer() as server:
+        Tarallo(server.url, server.token).get_item('asd')
+
+
+def test_get_item():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        item = tarallo_session.get_item('pc1')
+        assert type(item) == Item
+        assert item.code == 'PC1'
+        assert item.location == ['Warehouse', 'Shelf1']
+        assert len(item.contents) == 5
+        assert item.contents[1].product.features['type'] == 'cpu'
+
+
+def test_get_item_depth():
+    with FakeServer(computers=20) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        item = tarallo_session.get_item(FakeServer.ROOT, 1)
+        assert [shelf.code for shelf in item.contents] == ['Shelf1', 'Shelf2']
+        assert len(item.contents[0].contents) == 0
+
+
+def test_move_and_history():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        assert tarallo_session.move('R1', 'PC2')
+        assert tarallo_session.get_item('R1').location[-1] == 'PC2'
+        history = tarallo_session.get_history('R1')
+        assert history[0].change == AuditChanges.Move
+        assert history[0].other == 'PC2'
+        assert history[-1].change == AuditChanges.Create
+
+
+@raises(LocationNotFoundError)
+def test_move_item_not_existing_location():
+    with FakeServer() as server:
+        Tarallo(server.url, server.token).move('R1', 'INVALID')
+
+
+@raises(ValidationError)
+def test_move_item_impossible():
+    with FakeServer() as server:
+        Tarallo(server.url, server.token).move('R1', 'C1')
+
+
+def test_remove_restore_item():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        assert tarallo_session.remove_item('R1')
+        assert not tarallo_session.remove_item('PC2')
+        assert tarallo_session.remove_item('invalid') is None
+        assert tarallo_session.restore_item('R1', 'PC1')
+        assert tarallo_session.get_item('R1').location[-1] == 'PC1'
+
+
+def test_add_item():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        ram = ItemToUpload()
+        ram.features['type'] = 'ram'
+        ram.set_parent('Shelf1')
+        assert tarallo_session.add_item(ram)
+        assert tarallo_session.get_item(ram.code).location[-1] == 'Shelf1'
+
+
+def test_clone_and_serialize_contents():
+    with FakeServer() as server:
+        item = Tarallo(server.url, server.token).get_item('PC1')
+        # Only the top level item has a location
+        assert item.contents[0].location is None
+        serialized = item.serializable()
+        assert serialized['location'] == ['Warehouse', 'Shelf1']
+        assert 'location' not in serialized['contents'][0]
+        assert ItemToUpload().parent is None
+        clone = ItemToUpload(item)
+        assert clone.parent == 'Shelf1'
+        assert clone.contents[0].parent is None
+        assert [inner['code'] for inner in clone.serializable()['contents']] == ['B1', 'C1', 'R1', 'R2', 'H1']
+
+
+def test_update_features():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        assert tarallo_session.update_item_features('R1', {'color': 'red', 'sn': None})
+        features = tarallo_session.get_item('R1').features
+        assert features['color'] == 'red'
+        assert 'sn' not in features
+
+
+def test_codes_by_feature():
+    with FakeServer(computers=3) as server:
+        codes = Tarallo(server.url, server.token).get_codes_by_feature('type', 'ram')
+        assert sorted(codes) == ['R1', 'R2', 'R3', 'R4', 'R5', 'R6']
+
+
+def test_async_get_item():
+    with FakeServer() as server:
+        async def run():
+            async with AsyncTarallo(server.url, server.token) as tarallo_session:
+                return await asyncio.gather(tarallo_session.get_item('pc1'), tarallo_session.get_item('R3'),
+                                            tarallo_session.get_item('Shelf1', 0))
+
+        item, ram, shelf = run_async(run())
+        assert type(item) == Item
+        assert item.code == 'PC1'
+        assert item.location == ['Warehouse', 'Shelf1']
+        assert len(item.contents) == 5
+        assert item.contents[1].product.features['type'] == 'cpu'
+        assert ram.location[-1] == 'PC2'
+        assert len(shelf.contents) == 0
+
+
+@raises(ItemNotFoundError)
+def test_async_get_invalid_item():
+    with FakeServer() as server:
+        async def run():
+            async with AsyncTarallo(server.url, server.token) as tarallo_session:
+                await tarallo_session.get_item('asd')
+
+        run_async(run())
+
+
+def test_async_login():
+    with FakeServer() as server:
+        async def run():
+            async with AsyncTarallo(server.url, server.token) as valid, AsyncTarallo(server.url, 'invalid') as invalid:
+                return await valid.status(), await invalid.status()
+
+        assert run_async(run()) == (200, 401)
+
+
+def test_async_changes():
+    with FakeServer(computers=3) as server:
+        async def run():
+            async with AsyncTarallo(server.url, server.token) as tarallo_session:
+                assert await tarallo_session.move('R1', 'PC2')
+                assert await tarallo_session.update_item_features('R1', {'color': 'red', 'sn': None})
+                ram = ItemToUpload()
+                ram.features['type'] = 'ram'
+                ram.set_parent('Shelf1')
+                assert await tarallo_session.add_item(ram)
+                return (await tarallo_session.get_item('R1'), await tarallo_session.get_history('R1'),
+                        await tarallo_session.get_codes_by_feature('type', 'ram'), ram.code)
+
+        item, history, codes, code = run_async(run())
+        assert item.location[-1] == 'PC2'
+        assert item.features['color'] == 'red'
+        assert 'sn' not in item.features
+        assert history[0].change == AuditChanges.Update
+        assert history[1].change == AuditChanges.Move
+        assert history[-1].change == AuditChanges.Create
+        assert sorted(codes) == sorted(['R1', 'R2', 'R3', 'R4', 'R5', 'R6', code])
+
+
+def test_async_travaso():
+    with FakeServer(computers=3) as server:
+        async def run():
+            async with AsyncTarallo(server.url, server.token) as tarallo_session:
+                assert await tarallo_session.travaso('PC1', 'Shelf1')
+                # Same as the sync one, nothing else is moved after the first failure
+                with assert_raises(ValidationError):
+                    await tarallo_session.travaso('PC2', 'C3')
+                return await tarallo_session.get_item('Shelf1', 1), await tarallo_session.get_item('PC2')
+
+        shelf, pc2 = run_async(run())
+        moves = [path for method, path in server.log if method == 'PUT']
+        assert moves == [f'/v2/items/{code}/parent' for code in ('B1', 'C1', 'R1', 'R2', 'H1', 'B2')]
+        assert [item.code for item in shelf.contents] == ['PC1', 'PC2', 'PC3', 'B1', 'C1', 'R1', 'R2', 'H1']
+        assert len(pc2.contents) == 5
+
+
+@raises(ValidationError)
+def test_async_move_item_impossible():
+    with FakeServer() as server:
+        async def run():
+            async with AsyncTarallo(server.url, server.token) as tarallo_session:
+                await tarallo_session.move('R1', 'C1')
+
+        run_async(run())
+
+
+def test_bulk_add_duplicate():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        assert tarallo_session.bulk_add([{'type': 'I', 'features': {'type': 'case'}}], 'test')
+        assert not tarallo_session.bulk_add([{'type': 'I', 'features': {'type': 'case'}}], 'test')
+        assert tarallo_session.bulk_add([{'type': 'I', 'features': {'type': 'case'}}], 'test', True)
+
+
+def test_get_items():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        results = list(tarallo_session.get_items(['PC1', 'asd', 'R2'], depth_limit=0))
+        assert results[0][1].code == 'PC1'
+        assert isinstance(results[1][1], ItemNotFoundError)
+        assert results[2][1].code == 'R2'
+
+
+def test_cache_invalidation():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token, cache=ItemCache())
+        pc1 = tarallo_session.get_item('PC1')
+        assert tarallo_session.get_item('PC1') is pc1
+        tarallo_session.move('R1', 'PC2')
+        assert len(tarallo_session.get_item('PC1').contents) == 4
+        assert len(tarallo_session.get_item('PC2').contents) == 6
+
+
+def test_shared_products():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        pc1 = tarallo_session.get_item('PC1')
+        ram = pc1.contents[2].product
+        assert tarallo_session.get_item('R1').product is ram
+        assert tarallo_session.get_product(ram.brand, ram.model, ram.variant) is ram
+
+        # Changed on the server, by someone else
+        server.add_product(ram.brand, ram.model, ram.variant, dict(ram.features, color='red'))
+        product = tarallo_session.get_product(ram.brand, ram.model, ram.variant)
+        assert product.features['color'] == 'red'
+        assert product is not ram
+        # Items fetched before don't change under their users
+        assert ram.features['color'] == 'green'
+        assert pc1.contents[2].product is ram
+        assert tarallo_session.get_item('R1').product is product
+
+
+def test_lazy_item():
+    with FakeServer(computers=30) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        warehouse = tarallo_session.get_item(FakeServer.ROOT, 1, lazy=True)
+        requests = server.request_count
+        shelf = warehouse.contents[0]
+        assert not shelf.loaded
+        assert server.request_count == requests
+
+        # Fetched now, with the same depth limit
+        assert [pc.code for pc in shelf.contents] == [f'PC{n}' for n in range(1, 11)]
+        assert shelf.loaded
+        assert server.request_count == requests + 1
+        assert not shelf.contents[0].loaded
+        assert len(shelf.contents[0].contents) == 5
+        assert server.request_count == requests + 2
+
+        # Other shelves are still lazy
+        assert not warehouse.contents[1].loaded
+
+
+def test_lazy_item_prefetch():
+    with FakeServer(computers=30) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        warehouse = tarallo_session.get_item(FakeServer.ROOT, 1, lazy=True, prefetch_siblings=True)
+        requests = server.request_count
+        assert len(warehouse.contents[2].contents) == 10
+        assert server.request_count == requests + 3
+        assert all(shelf.loaded for shelf in warehouse.contents)
+
+
+def test_lazy_item_load_all():
+    latency = 0.05
+    with FakeServer(computers=10, latency=latency) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        warehouse = tarallo_session.get_item(FakeServer.ROOT, 1, lazy=True)
+        requests = server.request_count
+        start = time.monotonic()
+        clone = ItemToUpload(warehouse)
+        elapsed = time.monotonic() - start
+        # Shelf, computers and their components, each level at once instead of one request after another
+        lazy = 1 + 10 + 10 * 5
+        assert server.request_count == requests + lazy
+        assert elapsed < lazy * latency / 2
+        assert len(clone.contents[0].contents) == 10
+        assert all(pc.loaded for pc in warehouse.contents[0].contents)
+        # Nothing left to load
+        assert warehouse.serializable() == tarallo_session.get_item(FakeServer.ROOT).serializable()
+        assert server.request_count == requests + lazy + 1
+
+
+def test_lazy_item_sibling_errors():
+    class FlakyTarallo(Tarallo):
+        def get_item(self, code, *args, **kwargs):
+            if code == 'Shelf2':
+                raise ServerError("Injected error")
+            if code == 'Shelf3':
+                return None
+            return super().get_item(code, *args, **kwargs)
+
+    with FakeServer(computers=30) as server:
+        tarallo_session = FlakyTarallo(server.url, server.token)
+        warehouse = tarallo_session.get_item(FakeServer.ROOT, 1, lazy=True, prefetch_siblings=True)
+        shelf1, shelf2, shelf3 = warehouse.contents
+        # The siblings failed, but not this one
+        assert len(shelf1.contents) == 10
+        assert not shelf2.loaded and not shelf3.loaded
+        assert_raises(ServerError, getattr, shelf2, 'contents')
+        assert_raises(ServerError, getattr, shelf3, 'contents')
+        assert not shelf2.loaded and not shelf3.loaded
+
+
+def test_deep_tree():
+    # Deeper than the recursion limit
+    depth = 5000
+    data = {'code': f'D{depth}', 'features': {'type': 'location'}}
+    for n in range(depth - 1, 0, -1):
+        data = {'code': f'D{n}', 'features': {'type': 'location'}, 'contents': [data]}
+    data['location'] = ['Warehouse']
+
+    item = Item(data)
+    clone = ItemToUpload(item)
+    assert clone.parent == 'Warehouse'
+    for tree in (item.serializable(), clone.serializable()):
+        n = 0
+        while 'contents' in tree:
+            n += 1
+            assert tree['code'] == f'D{n}'
+            tree = tree['contents'][0]
+        assert n == depth - 1
+    assert len(str(item).split("\n")) == depth
+
+
+def test_slots():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        item = tarallo_session.get_item('PC1')
+        history = tarallo_session.get_history('PC1')
+        for obj in (item, item.contents[1], item.contents[1].product, ItemToUpload(item), history[0]):
+            assert not hasattr(obj, '__dict__')
+
+
+def test_item_to_upload_copies_features():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        item = tarallo_session.get_item('PC1')
+        clone = ItemToUpload(item)
+        ram = clone.contents[2]
+        assert type(ram.features) is dict
+        assert ram.features == item.contents[2].features
+        assert ram.features is not item.contents[2].features
+
+        # Changes to either of them don't show up in the other one
+        ram.features['working'] = 'yes'
+        del ram.features['sn']
+        assert item.contents[2].features['working'] == 'no'
+        assert 'sn' in item.contents[2].features
+        item.contents[3].features['color'] = 'red'
+        assert 'color' not in clone.contents[3].features
+        serialized = json.loads(json.dumps(clone.serializable()))
+        assert serialized['contents'][2]['features'] == {'type': 'ram', 'working': 'yes'}
+
+        for codec in ('json', 'orjson'):
+            tarallo_session.codec = get_codec(codec)
+            assert tarallo_session.update_item_features('R2', clone.contents[3].features)
+
+        index = ItemIndex(item)
+        index.update_features('H1', {'working': 'no'})
+        assert item.contents[4].features['working'] == 'no'
+        assert clone.contents[4].features['working'] == 'yes'
+        assert ItemDiff(item, clone).features['H1'] == {'working': 'yes'}
+
+
+@raises(ServerError)
+def test_injected_error():
+    with FakeServer() as server:
+        server.fail_next(1, 503)
+        Tarallo(server.url, server.token).get_item('R1')
+
+
+@raises(NoInternetConnectionError)
+def test_injected_disconnection():
+    with FakeServer() as server:
+        server.fail_next(1, None)
+        Tarallo(server.url, server.token).get_item('R1')
+
+
+def test_retry():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token, retry=RetryPolicy(max_retries=3, backoff=0.01))
+        server.fail_next(2, 503)
+        assert tarallo_session.get_item('R1').code == 'R1'
+        server.fail_next(1, None)
+        assert tarallo_session.move('R1', 'PC2')
+        assert server.request_count == 5
+
+
+@raises(ServerError)
+def test_retry_gives_up():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token, retry=RetryPolicy(max_retries=2, backoff=0.01))
+        server.fail_next(3, 500)
+        tarallo_session.get_item('R1')
+
+
+@raises(ServerError)
+def test_retry_not_idempotent():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token, retry=RetryPolicy(max_retries=3, backoff=0.01))
+        server.fail_next(1, 500)
+        ram = ItemToUpload()
+        ram.features['type'] = 'ram'
+        ram.set_parent('Shelf1')
+        # POST, not retried
+        tarallo_session.add_item(ram)
+
+
+def test_circuit_breaker():
+    with FakeServer() as server:
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        tarallo_session = Tarallo(server.url, server.token, circuit_breaker=breaker)
+        server.fail_next(3, 503)
+        for _ in range(2):
+            try:
+                tarallo_session.get_item('R1')
+                assert False
+            except ServerError as e:
+                assert not isinstance(e, CircuitOpenError)
+        assert breaker.state == CircuitBreaker.OPEN
+        try:
+            tarallo_session.get_item('R1')
+            assert False
+        except CircuitOpenError:
+            pass
+        # The server has not been contacted
+        assert server.request_count == 2
+
+        time.sleep(0.2)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        # Trial request fails, open again
+        try:
+            tarallo_session.get_item('R1')
+            assert False
+        except ServerError:
+            pass
+        assert breaker.state == CircuitBreaker.OPEN
+        time.sleep(0.2)
+        assert tarallo_session.get_item('R1').code == 'R1'
+        assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_trial_interrupted():
+    class FailingHooks(Hooks):
+        def before_request(self, span, method, url, headers):
+            raise RuntimeError("Hook failed")
+
+    with FakeServer() as server:
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+        tarallo_session = Tarallo(server.url, server.token, circuit_breaker=breaker)
+        server.fail_next(1, 503)
+        assert_raises(ServerError, tarallo_session.get_item, 'R1')
+        assert breaker.state == CircuitBreaker.OPEN
+        time.sleep(0.1)
+
+        # The trial request is never sent, the next one is the trial instead
+        late_session = Tarallo(server.url, server.token, circuit_breaker=breaker, deadline=0)
+        assert_raises(DeadlineExceededError, late_session.get_item, 'R1')
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        hooked_session = Tarallo(server.url, server.token, circuit_breaker=breaker, hooks=[FailingHooks()])
+        assert_raises(RuntimeError, hooked_session.get_item, 'R1')
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert tarallo_session.get_item('R1').code == 'R1'
+        assert breaker.state == CircuitBreaker.CLOSED
+
+
+@raises(RequestTimeoutError)
+def test_read_timeout():
+    with FakeServer(latency=0.2) as server:
+        Tarallo(server.url, server.token, read_timeout=0.05).get_item('R1')
+
+
+def test_deadline_composite():
+    with FakeServer(computers=20, latency=0.05) as server:
+        tarallo_session = Tarallo(server.url, server.token, deadline=0.2)
+        # One get_item and 5 moves, all within the same deadline
+        try:
+            tarallo_session.travaso('PC1', 'Shelf2')
+            assert False
+        except DeadlineExceededError:
+            pass
+        assert server.request_count < 6
+        # Each call has its own deadline
+        assert tarallo_session.get_item('R1').code == 'R1'
+
+
+def test_deadline_retry():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token, retry=RetryPolicy(max_retries=5, backoff=1),
+                                  deadline=0.5)
+        server.fail_next(5, 503)
+        start = time.monotonic()
+        try:
+            tarallo_session.get_item('R1')
+            assert False
+        except ServerError:
+            pass
+        # Gave up instead of sleeping past the deadline
+        assert time.monotonic() - start < 0.5
+
+
+def test_deadline_get_items():
+    with FakeServer(latency=0.1) as server:
+        tarallo_session = Tarallo(server.url, server.token, deadline=0.15)
+        results = {}
+        # The deadline is for all the items, not for each one
+        try:
+            for code, item in tarallo_session.get_items(['R1', 'R2', 'R3', 'R4'], max_workers=2):
+                results[code] = item
+            assert False
+        except DeadlineExceededError:
+            pass
+        assert sorted(results) == ['R1', 'R2']
+
+
+def test_feature_buffer():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        with FeatureBuffer(tarallo_session, max_delay=None) as buffer:
+            for n in range(10):
+                buffer.update_item_features('R1', {'color': 'red' if n % 2 else 'green', f'test-{n}': 'ok'})
+            buffer.update_item_features('r1', {'test-0': None})
+            buffer.update_item_features('asd', {'color': 'red'})
+            assert len(buffer) == 2
+            assert server.request_count == 0
+            results = buffer.flush()
+        assert server.request_count == 2
+        assert results['R1'] is True
+        assert isinstance(results['asd'], ItemNotFoundError)
+        features = tarallo_session.get_item('R1').features
+        assert features['color'] == 'red'
+        assert 'test-0' not in features
+        assert features['test-9'] == 'ok'
+
+
+def test_feature_buffer_thresholds():
+    with FakeServer() as server:
+        flushed = []
+        timer_flushed = threading.Event()
+
+        def on_flush(results):
+            flushed.append(results)
+            if len(flushed) == 2:
+                timer_flushed.set()
+
+        buffer = FeatureBuffer(Tarallo(server.url, server.token), max_items=2, max_delay=0.1, on_flush=on_flush)
+        buffer.update_item_features('R1', {'color': 'red'})
+        buffer.update_item_features('R2', {'color': 'red'})
+        # Full
+        assert flushed == [{'R1': True, 'R2': True}]
+        start = time.monotonic()
+        buffer.update_item_features('R3', {'color': 'red'})
+        # Too old, the timeout is only there in case it never happens
+        assert timer_flushed.wait(10)
+        assert time.monotonic() - start >= 0.1
+        assert flushed[1] == {'R3': True}
+        assert len(buffer) == 0
+
+
+def test_feature_buffer_automatic_errors():
+    with FakeServer() as server:
+        buffer = FeatureBuffer(Tarallo(server.url, server.token), max_items=2, max_delay=None)
+        buffer.update_item_features('R1', {'color': 'red'})
+        buffer.update_item_features('asd', {'color': 'red'})
+        # Full, flushed with nobody to report the error to
+        assert len(buffer) == 0
+        buffer.update_item_features('R2', {'color': 'red'})
+        results = buffer.close()
+        assert results['R2'] is True
+        assert isinstance(results['asd'], ItemNotFoundError)
+        assert 'R1' not in results
+        # Only once
+        assert buffer.flush() == {}
+
+
+def test_bulk_add_stream():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        upload = [{'type': 'I', 'features': {'type': 'ram', 'sn': f'SN{n}'}} for n in range(10000)]
+        assert tarallo_session.bulk_add_stream((element for element in upload), 'generator')
+        assert tarallo_session.bulk_add_stream(io.StringIO(json.dumps(upload)), 'file', compress=True)
+        assert tarallo_session.bulk_add_stream(iter(upload), 'file') is None
+        uploads = server.bulk_uploads()
+        assert uploads['generator'] == upload
+        assert uploads['file'] == upload
+
+
+def test_bulk_add_many():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        assert tarallo_session.bulk_add([{'type': 'I', 'features': {'type': 'case'}}], 'PC-2')
+        uploads = [(f'PC-{n}', [{'type': 'I', 'features': {'type': 'case', 'sn': str(n)}}]) for n in range(10)]
+        results = tarallo_session.bulk_add_many(uploads, compress=True)
+        assert results['PC-1'] is True
+        # Duplicate
+        assert results['PC-2'] is None
+        assert len(server.bulk_uploads()) == 10
+
+
+def test_codecs():
+    class CountingCodec(JsonCodec):
+        decoded = 0
+
+        def loads(self, data):
+            assert isinstance(data, bytes)
+            self.decoded += 1
+            return super().loads(data)
+
+    with FakeServer() as server:
+        for codec in ('json', 'orjson', CountingCodec()):
+            tarallo_session = Tarallo(server.url, server.token, codec=codec)
+            assert tarallo_session.get_item('PC1').contents[1].product.features['type'] == 'cpu'
+            assert tarallo_session.update_item_features('R1', {'color': 'red', 'note': 'àèìòù'})
+            assert tarallo_session.get_item('R1').features['note'] == 'àèìòù'
+            assert tarallo_session.get_history('R1')[0].change == AuditChanges.Update
+            assert 'R1' in tarallo_session.get_codes_by_feature('color', 'red')
+        assert codec.decoded == 4
+        assert isinstance(Tarallo(server.url, server.token).codec, OrjsonCodec)
+
+
+def test_validation_cache():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token, validation_cache=ValidationCache())
+        pc1 = tarallo_session.get_item('PC1')
+        history = tarallo_session.get_history('R1')
+        assert tarallo_session.get_item('PC1') is pc1
+        assert tarallo_session.get_history('R1') == history
+        assert tarallo_session.validation_cache.stats()['hits'] == 2
+        assert tarallo_session.validation_cache.stats()['bytes_saved'] > 0
+        assert server.request_count == 4
+
+        tarallo_session.move('R1', 'PC2')
+        assert len(tarallo_session.get_item('PC1').contents) == 4
+        assert len(tarallo_session.get_history('R1')) == len(history) + 1
+        # Lazy items aren't shared
+        assert tarallo_session.get_item('PC1', 0, lazy=True) is not tarallo_session.get_item('PC1', 0, lazy=True)
+
+
+def test_validation_cache_last_modified():
+    with FakeServer(validators=['Last-Modified']) as server:
+        tarallo_session = Tarallo(server.url, server.token, validation_cache=ValidationCache())
+        products = tarallo_session.get_product_list('Samsung', 'M3 78T1')
+        assert tarallo_session.get_product_list('Samsung', 'M3 78T1') == products
+        assert tarallo_session.validation_cache.stats()['hits'] == 1
+        # Anything changed, in the same second
+        tarallo_session.update_item_features('R1', {'color': 'red'})
+        assert tarallo_session.get_product_list('Samsung', 'M3 78T1') == products
+        assert tarallo_session.validation_cache.stats()['hits'] == 1
+
+    with FakeServer(validators=[]) as server:
+        tarallo_session = Tarallo(server.url, server.token, validation_cache=ValidationCache())
+        tarallo_session.get_item('PC1')
+        assert len(tarallo_session.validation_cache) == 0
+
+
+def test_metrics():
+    with FakeServer(computers=20) as server:
+        metrics = Metrics()
+        tarallo_session = Tarallo(server.url, server.token, metrics=metrics)
+        tarallo_session.travaso('PC1', 'Shelf2')
+        try:
+            tarallo_session.get_item('asd')
+        except ItemNotFoundError:
+            pass
+        tarallo_session.bulk_add_stream(iter([{'type': 'I', 'features': {'type': 'case'}}]), 'test')
+        tarallo_session.get('/v2/session')
+
+        snapshot = metrics.snapshot()
+        assert snapshot['travaso']['calls'] == 1
+        assert snapshot['travaso']['requests'] == 0
+        assert snapshot['move']['requests'] == 5
+        assert snapshot['move']['statuses'] == {'200': 5}
+        assert snapshot['move']['bytes_out'] > 0
+        assert snapshot['get_item']['calls'] == 2
+        assert snapshot['get_item']['errors'] == 1
+        assert snapshot['get_item']['statuses'] == {'200': 1, '404': 1}
+        assert snapshot['get_item']['bytes_in'] > 0
+        assert snapshot['get_item']['parse']['count'] == 1
+        assert snapshot['get_item']['network']['buckets']['+Inf'] == 2
+        assert snapshot['bulk_add_stream']['bytes_out'] > 0
+        assert snapshot['get']['requests'] == 1
+
+        text = metrics.prometheus()
+        assert '# TYPE pytarallo_request_duration_seconds histogram' in text
+        assert 'pytarallo_requests_total{operation="get_item",status="404"} 1' in text
+        assert 'pytarallo_operation_duration_seconds_count{operation="travaso"} 1' in text
+        assert 'pytarallo_parse_duration_seconds_bucket{operation="get_item",le="+Inf"} 1' in text
+
+
+def test_hooks_and_spans():
+    class RecordingHooks(Hooks):
+        def __init__(self):
+            self.events = []
+
+        def before_request(self, span, method, url, headers):
+            self.events.append(('before', span.name))
+            headers['X-Trace'] = 'test'
+
+        def after_response(self, span, response):
+            self.events.append(('after', response.status_code))
+
+        def on_error(self, span, error):
+            self.events.append(('error', span.name, type(error).__name__))
+
+    with FakeServer(computers=20) as server:
+        hooks = RecordingHooks()
+        recorder = SpanRecorder()
+        tarallo_session = Tarallo(server.url, server.token, hooks=[hooks, recorder])
+        tarallo_session.travaso('PC1', 'Shelf2')
+        travaso = recorder.spans[-1]
+        assert travaso.name == 'travaso'
+        assert [child.name for child in travaso.children] == ['get_item'] + ['move'] * 5
+        assert travaso.children[0].children[0].name == 'GET /v2/items/PC1'
+        assert travaso.children[0].children[0].attributes['http.status_code'] == 200
+        assert all(child.duration <= travaso.duration for child in travaso.children)
+        assert len(str(travaso).split('\n')) == 13
+        assert hooks.events[:2] == [('before', 'GET /v2/items/PC1'), ('after', 200)]
+
+        server.fail_next(1, None)
+        try:
+            tarallo_session.get_item('R1')
+            assert False
+        except NoInternetConnectionError:
+            pass
+        assert hooks.events[-2:] == [('error', 'GET /v2/items/R1', 'ConnectionError'),
+                                     ('error', 'get_item', 'NoInternetConnectionError')]
+        assert recorder.spans[-1].error is not None
+
+
+def test_iter_history():
+    with FakeServer(computers=1) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        for n in range(300):
+            tarallo_session.move('R1', 'Shelf1' if n % 2 == 0 else 'PC1')
+        tarallo_session.update_item_features('R1', {'color': 'red'})
+
+        history = tarallo_session.get_history('R1', 1000)
+        # Tiny chunks, to split entries everywhere
+        entries = list(tarallo_session.iter_history('R1', 1000, chunk_size=7))
+        assert [(entry.change, entry.other, entry.time) for entry in entries] == \
+               [(entry.change, entry.other, entry.time) for entry in history]
+        assert len(entries) == 302
+
+        for entry in tarallo_session.iter_history('R1', 1000):
+            if entry.change == AuditChanges.Move:
+                assert entry.other == 'PC1'
+                break
+        # The connection has been discarded, but the session still works
+        assert tarallo_session.get_item('R1').location[-1] == 'PC1'
+
+
+@raises(ItemNotFoundError)
+def test_iter_history_invalid_item():
+    with FakeServer() as server:
+        next(Tarallo(server.url, server.token).iter_history('asd'))
+
+
+def test_query():
+    with FakeServer(computers=20) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        runner = QueryRunner(tarallo_session)
+        working_ram = Feature('type', 'ram') & Feature('working', 'yes')
+        expected = set(tarallo_session.get_codes_by_feature('type', 'ram')) & \
+            set(tarallo_session.get_codes_by_feature('working', 'yes'))
+        requests = server.request_count
+        assert runner.codes(working_ram) == expected
+        assert server.request_count == requests + 2
+
+        # Cached, and with a few candidates left only their location is checked
+        on_shelf2 = working_ram & Location('Shelf2')
+        assert isinstance(on_shelf2, And) and len(on_shelf2.queries) == 3
+        assert len(expected) <= runner.max_candidates
+        assert runner.codes(on_shelf2) == {code for code in expected if int(code[1:]) > 20}
+        assert server.request_count == requests + 2 + len(expected)
+
+        # Too many candidates, everything inside the location is downloaded
+        requests = server.request_count
+        assert runner.codes(Location('Shelf2') & Feature('type', 'ram')) == {f'R{n}' for n in range(21, 41)}
+        assert server.request_count == requests + 1
+
+        # Nothing can match, the location isn't needed
+        assert runner.codes(Feature('color', 'red') & Location('Shelf1')) == set()
+        assert server.request_count == requests + 2
+
+        assert runner.codes(Or(Feature('type', 'cpu'), Feature('type', 'hdd'))) == \
+            {f'C{n}' for n in range(1, 21)} | {f'H{n}' for n in range(1, 21)}
+        assert runner.codes(Feature('type', 'ram') & Location('asd')) == set()
+        assert [item.code for item in runner.items(Feature('type', 'cpu') & Location('PC3'))] == ['C3']
+
+
+def test_query_ttl():
+    with FakeServer() as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        runner = QueryRunner(tarallo_session, ttl=0.1)
+        assert 'R1' not in runner.codes(Feature('color', 'red'))
+        tarallo_session.update_item_features('R1', {'color': 'red'})
+        assert 'R1' not in runner.codes(Feature('color', 'red'))
+        time.sleep(0.1)
+        assert 'R1' in runner.codes(Feature('color', 'red'))
+        assert runner.hits == 1 and runner.misses == 2
+
+
+def test_replica():
+    with FakeServer(computers=20) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        with Replica(tarallo_session) as replica:
+            assert replica.snapshot('Shelf1', 'Shelf2') == 2 + 20 * 6
+            requests = server.request_count
+
+            pc1 = replica.get_item('pc1')
+            remote = tarallo_session.get_item('PC1')
+            assert pc1.serializable() == remote.serializable()
+            assert pc1.location == remote.location == ['Warehouse', 'Shelf1']
+            assert pc1.contents[1].product.features == remote.contents[1].product.features
+            assert [item.code for item in replica.get_item('Shelf1', 1).contents] == [f'PC{n}' for n in range(1, 11)]
+            assert replica.location('R1') == ['Warehouse', 'Shelf1', 'PC1']
+            assert replica.contents('PC1') == ['B1', 'C1', 'R1', 'R2', 'H1']
+            assert len(replica.contents('Shelf2', recursive=True)) == 60
+            assert replica.codes_by_feature('type', 'ram') == sorted(f'R{n}' for n in range(1, 41))
+            # From the products
+            assert replica.codes_by_feature('cpu-socket', 'lga775') == sorted(f'C{n}' for n in range(1, 21))
+            assert len(replica.codes_by_product('Intel', 'Core 2 Duo E8200')) > 0
+            assert server.request_count == requests + 1
+
+            tarallo_session.move('R1', 'PC2')
+            tarallo_session.update_item_features('H3', {'working': 'no', 'sn': None})
+            tarallo_session.move('PC4', 'Shelf2')
+            assert tarallo_session.remove_item('R9')
+            tarallo_session.lose('R7')
+            # Created here, and moved here from somewhere else
+            case = ItemToUpload()
+            case.set_code('PC99')
+            case.features['type'] = 'case'
+            case.set_parent('Shelf1')
+            tarallo_session.add_item(case)
+            tarallo_session.move('R3', 'Warehouse')
+            tarallo_session.move('R3', 'PC99')
+            requests = server.request_count
+            changed = replica.sync()
+            assert server.request_count == requests + 2
+            assert changed == {'R1', 'H3', 'R9', 'R7', 'PC99', 'R3'} | {'PC4'} | set(replica.contents('PC4'))
+            assert replica.contents('PC99') == ['R3']
+            assert replica.location('R3') == ['Warehouse', 'Shelf1', 'PC99']
+            assert replica.contents('PC2')[-1] == 'R1'
+            assert replica.get_item('Shelf1').serializable() == tarallo_session.get_item('Shelf1').serializable()
+            assert replica.location('R1') == ['Warehouse', 'Shelf1', 'PC2']
+            assert replica.get_item('H3').features == tarallo_session.get_item('H3').features
+            assert replica.location('R8') == ['Warehouse', 'Shelf2', 'PC4']
+            assert 'R9' not in replica.contents('PC5')
+            assert 'R7' not in replica.contents('PC4')
+            try:
+                replica.location('R7')
+                assert False
+            except ItemNotFoundError:
+                pass
+
+            assert replica.sync() == set()
+
+
+def test_item_index():
+    with FakeServer(computers=20) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        index = ItemIndex(tarallo_session.get_item(FakeServer.ROOT))
+        assert len(index) == 1 + 2 + 20 * 6
+        assert index.path('r1') == ['Warehouse', 'Shelf1', 'PC1']
+        assert [item.code for item in index.find('type', 'cpu')] == sorted(f'C{n}' for n in range(1, 21))
+        # From the products
+        assert len(index.find('cpu-socket', 'lga775')) == 20
+        cpu = index.get('C1').product
+        assert index.get('C1') in index.by_product(cpu.brand, cpu.model)
+        assert index.by_product(cpu.brand, cpu.model) == index.by_product(cpu.brand, cpu.model, 'default')
+
+        index.move('PC1', 'Shelf2')
+        assert index.path('R1') == ['Warehouse', 'Shelf2', 'PC1']
+        assert index.get('PC1') in index.get('Shelf2').contents
+        assert index.get('PC1') not in index.get('Shelf1').contents
+        try:
+            index.move('Shelf2', 'PC1')
+            assert False
+        except ValueError:
+            pass
+
+        index.update_features('C1', {'cpu-socket': 'am2', 'working': None})
+        assert len(index.find('cpu-socket', 'lga775')) == 19
+        assert [item.code for item in index.find('cpu-socket', 'am2')] == ['C1']
+        assert 'C1' not in [item.code for item in index.find('working', 'yes')]
+
+        ram = tarallo_session.get_item('R3')
+        index.remove('R3')
+        assert 'R3' not in index
+        assert index.get('PC2').contents[-1].code != 'R3'
+        index.add(ram, 'PC1')
+        assert index.path('R3') == ['Warehouse', 'Shelf2', 'PC1']
+        assert ram.location is None
+        removed = index.remove('PC1')
+        assert all(code not in index for code in ('PC1', 'R1', 'R3', 'C1'))
+        assert index.find('cpu-socket', 'am2') == []
+        assert len(index) == 1 + 2 + 20 * 6 - len(removed.contents) - 1
+
+
+def test_item_diff():
+    with FakeServer(computers=20) as server:
+        tarallo_session = Tarallo(server.url, server.token)
+        shelf = tarallo_session.get_item('Shelf1')
+        edited = ItemToUpload(shelf)
+        assert not ItemDiff(shelf, edited)
+
+        pcs = {pc.code: pc for pc in edited.contents}
+        h1 = pcs['PC1'].contents[-1]
+        h1.features['working'] = 'no'
+        del h1.features['capacity-byte']
+        r1 = pcs['PC1'].contents[2]
+        pcs['PC1'].contents.remove(r1)
+        # Moved inside another computer that is moved too, so PC2 has to go first
+        edited.contents.remove(pcs['PC2'])
+        pcs['PC3'].add_content(pcs['PC2'])
+        pcs['PC2'].add_content(r1)
+        pcs['PC4'].contents.pop()
+        edited.contents.remove(pcs['PC5'])
+        assert shelf.contents[0].contents[-1].features['working'] == 'yes'
+
+        diff = ItemDiff(shelf, edited)
+        assert diff.features == {'H1': {'working': 'no', 'capacity-byte': None}}
+        assert diff.moves == {'PC2': 'PC3', 'R1': 'PC2'}
+        # Only the computer, not everything inside it
+        assert sorted(diff.losses) == ['H4', 'PC5']
+        assert len(diff) == 5
+
+        requests = server.request_count
+        results = diff.apply(tarallo_session, max_workers=4)
+        assert results == {'features': {'H1': True}, 'moves': {'PC2': True, 'R1': True},
+                           'losses': {'H4': True, 'PC5': True}}
+        assert server.request_count == requests + 5
+        assert tarallo_session.get_item('H1').features == {'type': 'hdd', 'working': 'no'}
+        assert tarallo_session.get_item('R1').location == ['Warehouse', 'Shelf1', 'PC3', 'PC2']
+        assert not ItemDiff(tarallo_session.get_item('Shelf1'), edited)
+
+        pcs['PC6'].add_content(ItemToUpload())
+        assert_raises(ValueError, ItemDiff, shelf, edited)
+
+
+def test_single_flight():
+    with FakeServer(latency=0.2) as server:
+        metrics = Metrics()
+        tarallo_session = Tarallo(server.url, server.token, metrics=metrics, single_flight=True)
+
+        def concurrently(func, threads=8):
+            barrier = threading.Barrier(threads)
+
+            def call():
+                barrier.wait()
+                try:
+                    return func()
+                except Exception as e:
+                    return e
+
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                return [future.result() for future in [executor.submit(call) for _ in range(threads)]]
+
+        requests = server.request_count
+        items = concurrently(lambda: tarallo_session.get_item('PC1'))
+        assert server.request_count == requests + 1
+        assert all(item is items[0] for item in items)
+        assert items[0].contents[2].code == 'R1'
+        assert metrics.snapshot()['get_item']['shared'] == 7
+        assert 'pytarallo_shared_requests_total{operation="get_item"} 7' in metrics.prometheus()
+
+        errors = concurrently(lambda: tarallo_session.get_item('asd'))
+        assert server.request_count == requests + 2
+        assert all(isinstance(error, ItemNotFoundError) for error in errors)
+
+        # Not shared, they change as they're loaded
+        items = concurrently(lambda: tarallo_session.get_item('PC1', 0, lazy=True), 4)
+        assert server.request_count == requests + 6
+        assert len({id(item) for item in items}) == 4
+
+        tarallo_session.single_flight = False
+        concurrently(lambda: tarallo_session.get_item('PC1'), 4)
+        assert server.request_count == requests + 10
+
+
+def test_single_flight_interrupted():
+    class Interrupt(Hooks):
+        def __init__(self):
+            self.started = threading.Event()
+
+        def before_request(self, span, method, url, headers):
+            if not self.started.is_set():
+                self.started.set()
+                time.sleep(0.2)
+                raise KeyboardInterrupt
+
+    with FakeServer() as server:
+        hook = Interrupt()
+        tarallo_session = Tarallo(server.url, server.token, hooks=[hook], single_flight=True)
+        interrupted = []
+
+        def leader():
+            try:
+                tarallo_session.get_item('PC1')
+            except KeyboardInterrupt:
+                interrupted.append(True)
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        hook.started.wait()
+        # Joins the request of the other thread, then sends its own
+        assert tarallo_session.get_item('PC1').code == 'PC1'
+        thread.join()
+        assert interrupted == [True]